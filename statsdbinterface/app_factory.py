@@ -23,6 +23,12 @@ def create_app(data_dir):
 
     app.config['SQLALCHEMY_DATABASE_URI'] = (
         'sqlite:///%s/stats.sqlite' % (data_dir.rstrip('/')))
+    app.config['INDEX_PATH'] = (
+        '%s/interface-index.sqlite' % (data_dir.rstrip('/')))
+    app.config['PRECACHE_PATH'] = (
+        '%s/interface-precache.bin' % (data_dir.rstrip('/')))
+    app.config['CACHE_DISK_PATH'] = (
+        '%s/interface-cache.sqlite' % (data_dir.rstrip('/')))
 
     # Load the rest of the program.
     from .database.core import setup_db
@@ -39,8 +45,13 @@ def create_app(data_dir):
     from .error_handling import setup_app
     setup_app(app)
 
-    # Begin cache cleaner.
+    # Begin cache cleaner, invalidating entries when the data changes.
     from . import function_cache
-    function_cache.setup()
+    from .database.core import data_version
+    function_cache.setup(app, data_version)
+
+    # Recompute the registered rankings in the background.
+    from . import scheduler
+    scheduler.setup(app)
 
     return app
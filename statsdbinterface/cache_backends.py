@@ -0,0 +1,296 @@
+import hashlib
+import pickle
+import socket
+import sqlite3
+import time
+import traceback
+from threading import Lock
+
+
+class Backend:
+    """
+    Second cache tier behind the in-process cache in function_cache.
+    Backends must never raise, a failure is treated as a miss.
+    """
+
+    def get(self, key, version):
+        """
+        Return (created, results) for key if it was stored under version and
+        has not expired, otherwise None.
+        """
+        return None
+
+    def put(self, key, version, created, seconds, results):
+        """
+        Store results for key, expiring seconds after created.
+        """
+        pass
+
+    def stats(self):
+        return {}
+
+
+class DiskCache(Backend):
+    """
+    Holds pickled results in a sidecar SQLite file so a new process can
+    serve them without recomputing.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key BLOB PRIMARY KEY,
+                version BLOB,
+                created REAL,
+                seconds REAL,
+                accessed REAL,
+                size INTEGER,
+                value BLOB
+            )''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS entries_accessed
+            ON entries (accessed)''')
+        self.conn.commit()
+        self.bytes = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def get(self, key, version):
+        try:
+            pkey = pickle.dumps(key)
+        except Exception:
+            traceback.print_exc()
+            return None
+        with self.lock:
+            total = self.bytes
+            try:
+                row = self.conn.execute(
+                    'SELECT version, created, seconds, value FROM entries '
+                    'WHERE key = ?', (pkey,)).fetchone()
+                if row is None:
+                    return None
+                if (pickle.loads(row[0]) != version or
+                        time.time() - row[1] >= row[2]):
+                    self._delete(pkey)
+                    self.conn.commit()
+                    return None
+                self.conn.execute(
+                    'UPDATE entries SET accessed = ? WHERE key = ?',
+                    (time.time(), pkey))
+                self.conn.commit()
+            except Exception:
+                self._rollback(total)
+                return None
+        try:
+            return row[1], pickle.loads(row[3])
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def put(self, key, version, created, seconds, results):
+        """
+        Store results for key, evicting the least recently used entries to
+        stay within max_bytes.
+        """
+        try:
+            pkey = pickle.dumps(key)
+            value = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Not everything can be stored, keep it in memory only.
+            return
+        size = len(pkey) + len(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.lock:
+            total = self.bytes
+            try:
+                self._delete(pkey)
+                self.conn.execute(
+                    'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (pkey, pickle.dumps(version), created, seconds,
+                     time.time(), size, value))
+                self.bytes += size
+                while (self.max_bytes is not None and
+                       self.bytes > self.max_bytes):
+                    row = self.conn.execute(
+                        'SELECT key FROM entries WHERE key != ? '
+                        'ORDER BY accessed LIMIT 1', (pkey,)).fetchone()
+                    if row is None:
+                        break
+                    self._delete(row[0])
+                self.conn.commit()
+            except Exception:
+                # E.g. the file is locked by another process, the results
+                # stay in memory only.
+                self._rollback(total)
+
+    def _delete(self, pkey):
+        # Remove an entry, self.lock must be held.
+        row = self.conn.execute(
+            'SELECT size FROM entries WHERE key = ?', (pkey,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (pkey,))
+            self.bytes -= row[0]
+
+    def _rollback(self, total):
+        # Undo a failed transaction, restoring the byte count from before.
+        # self.lock must be held.
+        traceback.print_exc()
+        try:
+            self.conn.rollback()
+        except Exception:
+            traceback.print_exc()
+        self.bytes = total
+
+    def stats(self):
+        with self.lock:
+            try:
+                entries = self.conn.execute(
+                    'SELECT COUNT(*) FROM entries').fetchone()[0]
+            except Exception:
+                traceback.print_exc()
+                entries = None
+        return {
+            "backend": "disk",
+            "path": self.path,
+            "entries": entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class MemcachedCache(Backend):
+    """
+    Holds pickled results on a server speaking the memcached text protocol,
+    so every process in a cluster shares them.
+    """
+
+    def __init__(self, host, port, prefix='statsdbinterface', timeout=1):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lock = Lock()
+        self.sock = None
+        self.errors = 0
+
+    def _key(self, key):
+        # Memcached keys are limited to 250 characters without whitespace.
+        return '%s:%s' % (self.prefix,
+                          hashlib.sha1(pickle.dumps(key)).hexdigest())
+
+    def _connect(self):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 self.timeout)
+            self.buffer = b''
+        return self.sock
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def _readline(self):
+        while b'\r\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Memcached connection closed.")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    def _read(self, size):
+        while len(self.buffer) < size + 2:
+            data = self.sock.recv(max(65536, size + 2 - len(self.buffer)))
+            if not data:
+                raise ConnectionError("Memcached connection closed.")
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size + 2:]
+        return data
+
+    def _command(self, f):
+        # Run f with the lock held, dropping the connection on errors.
+        with self.lock:
+            try:
+                self._connect()
+                return f()
+            except Exception:
+                self.errors += 1
+                self._close()
+                traceback.print_exc()
+                return None
+
+    def get(self, key, version):
+        mkey = self._key(key)
+
+        def command():
+            self.sock.sendall(('get %s\r\n' % mkey).encode())
+            value = None
+            while True:
+                line = self._readline()
+                if line == b'END':
+                    return value
+                parts = line.split()
+                if parts[0] != b'VALUE':
+                    raise ConnectionError("Unexpected reply %r." % line)
+                value = self._read(int(parts[3]))
+
+        value = self._command(command)
+        if value is None:
+            return None
+        try:
+            stored_version, created, seconds, results = pickle.loads(value)
+        except Exception:
+            traceback.print_exc()
+            return None
+        if stored_version != version or time.time() - created >= seconds:
+            return None
+        return created, results
+
+    def put(self, key, version, created, seconds, results):
+        mkey = self._key(key)
+        try:
+            value = pickle.dumps((version, created, seconds, results),
+                                 pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Not everything can be stored, keep it in memory only.
+            return
+        # Expiry times over 30 days are read as timestamps by memcached.
+        exptime = min(int(seconds) + 1, 30 * 24 * 60 * 60)
+
+        def command():
+            self.sock.sendall(('set %s 0 %d %d\r\n' % (
+                mkey, exptime, len(value))).encode() + value + b'\r\n')
+            line = self._readline()
+            if line != b'STORED':
+                raise ConnectionError("Unexpected reply %r." % line)
+
+        self._command(command)
+
+    def stats(self):
+        return {
+            "backend": "memcached",
+            "server": "%s:%d" % (self.host, self.port),
+            "errors": self.errors,
+        }
+
+
+def from_config(config):
+    """
+    Return the Backend selected by CACHE_BACKEND, or None.
+    """
+    name = config.get('CACHE_BACKEND')
+    if name is None:
+        return None
+    if name == 'disk':
+        return DiskCache(config['CACHE_DISK_PATH'],
+                         config.get('CACHE_DISK_MAX_BYTES'))
+    if name == 'memcached':
+        host, port = config.get('CACHE_MEMCACHED_SERVER',
+                                ('127.0.0.1', 11211))
+        return MemcachedCache(host, port)
+    assert False, "Unknown CACHE_BACKEND %r." % name
@@ -1,10 +1,17 @@
 from flask_sqlalchemy import SQLAlchemy
 import inspect
+import logging
+import os
+import time
 import traceback
+from threading import Event, Thread
 
 
 db_functions = []
 
+# Set once the precache, gameflags and rollups tables cover the database.
+warm = Event()
+
 
 def db_function(name):
     """
@@ -38,6 +45,12 @@ def setup_db(app):
     # Create the SQLAlchemy connection.
 
     with app.app_context():
+        @db.event.listens_for(db.engine, 'connect')
+        def attach_index(conn, record):
+            # Sidecar database for derived tables, see gameflags.
+            conn.execute("ATTACH DATABASE ? AS flags",
+                         (app.config['INDEX_PATH'],))
+
         @db.event.listens_for(db.engine, 'begin')
         def register_functions(conn):
             for f in db_functions:
@@ -45,8 +58,85 @@ def setup_db(app):
 
     # Register models, functions and views.
     from .. import redeclipse, views  # noqa
-    from . import models  # noqa
+    from . import models, gameflags, rollups  # noqa
 
     with app.app_context():
-        redeclipse.functions.build_precache()
-        redeclipse.versions.build_precache()
+        gameflags.setup()
+        rollups.setup()
+
+    if app.config.get('BACKGROUND_WARMUP'):
+        # Serve requests right away, they fall back to slower queries until
+        # warm is set.
+        Thread(target=warm_up, args=(app,), daemon=True).start()
+    else:
+        warm_up(app)
+
+
+def warm_up(app):
+    """
+    Build the precache, gameflags and rollups tables, then set warm.
+    """
+    from .. import redeclipse
+    from . import gameflags, rollups
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    try:
+        with app.app_context():
+            redeclipse.functions.build_precache(
+                app.config['PRECACHE_PATH']
+                if app.config.get('PRECACHE_SNAPSHOT') else None)
+            gameflags.update()
+            rollups.update()
+    except Exception:
+        logger.exception("Warm-up failed.")
+        raise
+    warm.set()
+    logger.info("Warm-up finished in %.2fs.", time.time() - start)
+    Thread(target=updater, args=(app,), daemon=True).start()
+
+
+def update_tables():
+    """
+    Add the games newer than their watermarks to the precache, gameflags
+    and rollups tables.
+    """
+    from .models import Game
+    from . import gameflags, rollups
+    from .. import redeclipse
+    latest = Game.query.with_entities(db.func.max(Game.id)).scalar()
+    if latest is None:
+        return
+    if latest > redeclipse.functions.precache["last"]:
+        redeclipse.functions.update_precache()
+    if latest > gameflags.watermark:
+        gameflags.update()
+    if latest > rollups.watermark:
+        rollups.update()
+
+
+def updater(app):
+    # Runs update_tables() in the background after warm-up, queries cover
+    # the newer games with slower fallbacks until it has.
+    logger = logging.getLogger(__name__)
+    interval = app.config.get('CACHE_VERSION_INTERVAL', 10)
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                update_tables()
+        except Exception:
+            logger.exception("Updating the derived tables failed.")
+
+
+def data_version():
+    """
+    Return a version identifying the current database contents.
+    It changes when games are added or the database file is modified.
+    """
+    from .models import Game
+    latest = Game.query.with_entities(db.func.max(Game.id)).scalar()
+    try:
+        mtime = os.path.getmtime(db.engine.url.database)
+    except (OSError, TypeError):
+        mtime = None
+    return (latest, mtime)
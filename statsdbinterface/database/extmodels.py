@@ -2,7 +2,8 @@ from flask import current_app
 from werkzeug.exceptions import NotFound
 from .core import db
 from .models import Game, GamePlayer, GameServer, GameWeapon
-from .modelutils import direct_to_dict, to_pagination
+from .modelutils import count_by, direct_to_dict, to_pagination
+from . import gameflags
 from .. import redeclipse
 from .. function_cache import cached
 
@@ -91,79 +92,71 @@ class Player:
         else:
             return list(reversed(self.game_ids))[:number]
 
-    @cached(5 * 60, 'handle')
+    @cached(60 * 60, 'handle', maxentries=2000)
     def dpm(self, games_ago):
         games = self.last_games(games_ago)
         d1, d2 = GameWeapon.query.with_entities(
             db.func.sum(GameWeapon.damage1),
             db.func.sum(GameWeapon.damage2)).filter(
                 GameWeapon.game_id.in_(games),
-                db.func.re_normal_weapons(GameWeapon.game_id),
+                gameflags.re_normal_weapons(GameWeapon.game_id),
                 GameWeapon.playerhandle == self.handle
                 ).first()
         time = GamePlayer.query.with_entities(
             db.func.sum(GamePlayer.timealive)).filter(
                 GamePlayer.game_id.in_(games),
-                db.func.re_normal_weapons(GamePlayer.game_id),
+                gameflags.re_normal_weapons(GamePlayer.game_id),
                 GamePlayer.handle == self.handle
                 ).first()[0]
         return ((d1 or 0) + (d2 or 0)) / (max(1, (time or 0)) / 60)
 
-    @cached(5 * 60, 'handle')
+    @cached(60 * 60, 'handle', maxentries=2000)
     def fpm(self, games_ago):
         games = self.last_games(games_ago)
         time, frags = GamePlayer.query.with_entities(
             db.func.sum(GamePlayer.timealive),
             db.func.sum(GamePlayer.frags)).filter(
                 GamePlayer.game_id.in_(games),
-                db.func.re_normal_weapons(GamePlayer.game_id),
+                gameflags.re_normal_weapons(GamePlayer.game_id),
                 GamePlayer.handle == self.handle
                 ).first()
         return (frags or 0) / (max(1, (time or 0)) / 60)
 
-    @cached(5 * 60, 'handle')
+    @cached(60 * 60, 'handle', maxentries=2000)
     def kdr(self, games_ago):
         games = self.last_games(games_ago)
         frags, deaths = GamePlayer.query.with_entities(
             db.func.sum(GamePlayer.frags),
             db.func.sum(GamePlayer.deaths)).filter(
                 GamePlayer.game_id.in_(games),
-                db.func.re_normal_weapons(GamePlayer.game_id),
+                gameflags.re_normal_weapons(GamePlayer.game_id),
                 GamePlayer.handle == self.handle
                 ).first()
         return (frags or 0) / max(1, deaths or 0)
 
-    @cached(5 * 60, 'handle')
+    @cached(60 * 60, 'handle', maxentries=2000)
     def dfr(self, games_ago):
         games = self.last_games(games_ago)
         d1, d2 = GameWeapon.query.with_entities(
             db.func.sum(GameWeapon.damage1),
             db.func.sum(GameWeapon.damage2)).filter(
                 GameWeapon.game_id.in_(games),
-                db.func.re_normal_weapons(GameWeapon.game_id),
+                gameflags.re_normal_weapons(GameWeapon.game_id),
                 GameWeapon.playerhandle == self.handle
                 ).first()
         frags = GamePlayer.query.with_entities(
             db.func.sum(GamePlayer.frags)).filter(
                 GamePlayer.game_id.in_(games),
-                db.func.re_normal_weapons(GamePlayer.game_id),
+                gameflags.re_normal_weapons(GamePlayer.game_id),
                 GamePlayer.handle == self.handle
                 ).first()[0]
         return ((d1 or 0) + (d2 or 0)) / max(1, frags or 0)
 
-    @cached(5 * 60, 'handle')
+    @cached(60 * 60, 'handle', maxentries=2000)
     def topmaps(self, games_ago):
         games = self.last_games(games_ago)
-        maps = [r[0] for r in (Game.query
-                               .with_entities(Game.map)
-                               .filter(Game.id.in_(games))
-                               )]
-        ret = {}
-        for map_ in set(maps):
-            ret[map_] = maps.count(map_)
-        return [{"name": m, "games": ret[m]}
-                for m in sorted(sorted(ret),
-                                key=lambda m: ret[m], reverse=True)]
+        return [{"name": map_, "games": count}
+                for map_, count in count_by(Game.map, Game.id.in_(games))]
 
     def weapons(self):
         ret = {}
@@ -263,8 +256,8 @@ class Map:
         if race:
             return [r[0] for r in
                     Game.query.with_entities(Game.map)
-                    .filter(db.func.re_mode(Game.id, 'race'))
-                    .filter(db.func.re_mut(Game.id, 'timed'))
+                    .filter(gameflags.re_mode(Game.id, 'race'))
+                    .filter(gameflags.re_mut(Game.id, 'timed'))
                     .group_by(Game.map)
                     .order_by(Game.id.desc()).all()]
         # Return a list of all map names in the database.
@@ -277,8 +270,8 @@ class Map:
         # Return the number of maps in the database.
         if race:
             return (Game.query.with_entities(Game.map)
-                    .filter(db.func.re_mode(Game.id, 'race'))
-                    .filter(db.func.re_mut(Game.id, 'timed'))
+                    .filter(gameflags.re_mode(Game.id, 'race'))
+                    .filter(gameflags.re_mut(Game.id, 'timed'))
                     .group_by(Game.map).count())
         return Game.query.with_entities(Game.map).group_by(Game.map).count()
 
@@ -372,13 +365,13 @@ class Map:
                 # Only games from this map.
                 .filter(GamePlayer.game_id.in_(self.game_ids))
                 # Only timed race.
-                .filter(db.func.re_mode(GamePlayer.game_id, 'race'))
-                .filter(db.func.re_mut(GamePlayer.game_id, 'timed'))
+                .filter(gameflags.re_mode(GamePlayer.game_id, 'race'))
+                .filter(gameflags.re_mut(GamePlayer.game_id, 'timed'))
                 .filter(True
                         if not endurance else
-                        db.func.re_mut(GamePlayer.game_id, 'endurance'))
+                        gameflags.re_mut(GamePlayer.game_id, 'endurance'))
                 # No freestyle.
-                .filter(~db.func.re_mut(GamePlayer.game_id, 'freestyle'))
+                .filter(~gameflags.re_mut(GamePlayer.game_id, 'freestyle'))
                 # Scores of 0 indicate the race was never completed.
                 .filter(GamePlayer.score > 0)
                 # Get only the best score from each handle.
@@ -429,11 +422,8 @@ class Mode:
         re = redeclipse.versions.default
         self.name = name
         self.longname = re.modestr[re.modes[self.name]]
-        self.game_ids = [
-            r[0] for r in
-            Game.query.with_entities(Game.id).filter(
-                db.func.re_mode(Game.id, self.name)).all()
-        ]
+        self.game_ids = list(
+            redeclipse.functions.precached_games(mode=self.name))
 
     def mode_str(self, short=False):
         return self.name if short else self.longname
@@ -497,20 +487,12 @@ class Mutator:
     def __init__(self, name):
         self.name = name
         if '-' in self.name:
-            self.game_ids = [
-                r[0] for r in
-                Game.query.with_entities(Game.id)
-                .filter(db.func.re_mut(Game.id, self.name.split("-")[1]))
-                .filter(db.func.re_mode(Game.id, self.name.split("-")[0]))
-                .all()
-            ]
+            mode, mutator = self.name.split("-")
+            self.game_ids = list(redeclipse.functions.precached_games(
+                mode=mode, mutator=mutator))
         else:
-            self.game_ids = [
-                r[0] for r in
-                Game.query.with_entities(Game.id)
-                .filter(db.func.re_mut(Game.id, self.name))
-                .all()
-            ]
+            self.game_ids = list(
+                redeclipse.functions.precached_games(mutator=self.name))
 
     def games(self, page=0, pagesize=None):
         # Return full Game objects from Mutator's game_ids.
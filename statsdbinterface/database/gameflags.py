@@ -0,0 +1,232 @@
+"""
+Materialized mode, mutator and version information for each game.
+
+The rows live in a sidecar database attached to every connection as
+'flags', so they can be filtered with indexed SQL instead of decoding each
+game's mode and mutators while querying.
+Games newer than the watermark, which update() has not added yet, are
+decoded while querying.
+"""
+import json
+from threading import Lock
+from .core import db, db_function
+from .models import Game, GameServer
+from .. import redeclipse
+
+
+SCHEMA = 'flags'
+
+# Rows are added in batches of this many games.
+BATCH_SIZE = 10000
+
+update_lock = Lock()
+# Highest game id with committed flags.
+watermark = 0
+# game_flags() results by (mode, mutators, version).
+decoded = {}
+
+
+class GameFlags(db.Model):
+    __tablename__ = 'game_flags'
+    __table_args__ = (
+        db.Index('game_flags_mode', 'mode', 'game'),
+        db.Index('game_flags_normal_weapons', 'normal_weapons', 'game'),
+        {'schema': SCHEMA},
+    )
+
+    game_id = db.Column('game', db.Integer, primary_key=True)
+    vclass = db.Column(db.Text)
+    mode = db.Column(db.Text)
+    mutators = db.Column(db.Integer)
+    normal_weapons = db.Column(db.Boolean)
+
+
+class GameMutator(db.Model):
+    __tablename__ = 'game_mutators'
+    __table_args__ = (
+        db.Index('game_mutators_mutator', 'mutator', 'game'),
+        {'schema': SCHEMA},
+    )
+
+    game_id = db.Column('game', db.Integer, primary_key=True)
+    mutator = db.Column(db.Text, primary_key=True)
+
+
+class FlagsMeta(db.Model):
+    __tablename__ = 'meta'
+    __table_args__ = {'schema': SCHEMA}
+
+    key = db.Column(db.Text, primary_key=True)
+    value = db.Column(db.Text)
+
+
+def decode(mode, mutators, version):
+    if (mode, mutators, version) not in decoded:
+        decoded[(mode, mutators, version)] = game_flags(
+            None, mode, mutators, version)
+    return decoded[(mode, mutators, version)]
+
+
+@db_function('re_game_mode')
+def sql_game_mode(mode, mutators, version):
+    return decode(mode, mutators, version)[0]["mode"]
+
+
+@db_function('re_game_mut')
+def sql_game_mut(mode, mutators, version, mutator):
+    return mutator in decode(mode, mutators, version)[1]
+
+
+@db_function('re_game_normal_weapons')
+def sql_game_normal_weapons(mode, mutators, version):
+    return decode(mode, mutators, version)[0]["normal_weapons"]
+
+
+def _flagged(game_id, flagged, condition):
+    # Games up to the watermark are in the flags tables, the newer ones are
+    # matched by decoding them. They are only the games update() has not
+    # reached yet, so this stays cheap.
+    return db.or_(game_id.in_(flagged), game_id.in_(
+        db.select([Game.id])
+        .select_from(Game.__table__.outerjoin(
+            GameServer.__table__, GameServer.game_id == Game.id))
+        .where(Game.id > watermark)
+        .where(condition(Game.mode, Game.mutators, GameServer.version))))
+
+
+def re_mode(game_id, mode):
+    """
+    SQL expression, True if the game <game_id> is of mode <mode>.
+    """
+    return _flagged(game_id,
+                    db.select([GameFlags.game_id])
+                    .where(GameFlags.mode == mode),
+                    lambda *game: db.func.re_game_mode(*game) == mode)
+
+
+def re_mut(game_id, mutator):
+    """
+    SQL expression, True if the game <game_id> has mutator <mutator>.
+    """
+    return _flagged(game_id,
+                    db.select([GameMutator.game_id])
+                    .where(GameMutator.mutator == mutator),
+                    lambda *game: db.func.re_game_mut(*game, mutator))
+
+
+def re_normal_weapons(game_id):
+    """
+    SQL expression, True if the game <game_id> uses the standard weapons.
+    """
+    return _flagged(game_id,
+                    db.select([GameFlags.game_id])
+                    .where(GameFlags.normal_weapons),
+                    db.func.re_game_normal_weapons)
+
+
+def game_flags(game_id, mode, mutators, version):
+    """
+    Return (flags row, mutator names) for a game.
+    """
+    vclass = redeclipse.versions.get_version_class(
+        version or redeclipse.versions.DEFAULT_VERSION)
+    modename = vclass.cmodestr.get(mode)
+    muts = vclass.mutslist(mode, mutators)
+    normal = (modename not in vclass.nonstandard_weapons['modes'] and
+              not set(muts) & set(vclass.nonstandard_weapons['mutators']))
+    return ({
+        "game": game_id,
+        "vclass": type(vclass).__name__,
+        "mode": modename,
+        "mutators": mutators,
+        "normal_weapons": normal,
+    }, muts)
+
+
+def fingerprint(conn, last):
+    """
+    Return a string identifying the stats database up to game <last>, from
+    the id and time of its first game and of game <last>.
+    """
+    first = conn.execute(db.select([Game.id, Game.time])
+                         .order_by(Game.id).limit(1)).first()
+    end = conn.execute(db.select([Game.id, Game.time])
+                       .where(Game.id == last)).first()
+    return json.dumps([first and list(first), end and list(end)])
+
+
+def meta(conn, key):
+    """
+    Return the FlagsMeta value of <key>, or None.
+    """
+    return conn.execute(db.select([FlagsMeta.value])
+                        .where(FlagsMeta.key == key)).scalar()
+
+
+def set_meta(conn, key, value):
+    conn.execute(FlagsMeta.__table__.delete().where(FlagsMeta.key == key))
+    conn.execute(FlagsMeta.__table__.insert(), key=key, value=value)
+
+
+def setup():
+    """
+    Create the tables, clearing them if the version classes or the stats
+    database changed, and read the watermark.
+    """
+    global watermark
+    with db.engine.begin() as conn:
+        for model in (GameFlags, GameMutator, FlagsMeta):
+            model.__table__.create(conn, checkfirst=True)
+        current = redeclipse.versions.signature()
+        last = conn.execute(
+            db.select([db.func.max(GameFlags.game_id)])).scalar() or 0
+        if (meta(conn, 'signature') != current or
+                (last and meta(conn, 'fingerprint') !=
+                 fingerprint(conn, last))):
+            # The version classes changed or the stats database was
+            # replaced, rebuild everything.
+            last = 0
+            conn.execute(GameFlags.__table__.delete())
+            conn.execute(GameMutator.__table__.delete())
+            set_meta(conn, 'signature', current)
+            set_meta(conn, 'fingerprint', fingerprint(conn, 0))
+    watermark = last
+
+
+def update():
+    """
+    Add flags for every game newer than the watermark.
+    Each batch is committed on its own, so queries can use it right away.
+    Return the number of games added.
+    """
+    global watermark
+    added = 0
+    with update_lock:
+        setup()
+        while True:
+            rows = db.engine.execute(
+                db.select([Game.id, Game.mode, Game.mutators,
+                           GameServer.version])
+                .select_from(Game.__table__.outerjoin(
+                    GameServer.__table__, GameServer.game_id == Game.id))
+                .where(Game.id > watermark)
+                .order_by(Game.id)
+                .limit(BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            flags = []
+            mutators = []
+            for row in rows:
+                game, muts = decode(*row[1:])
+                flags.append(dict(game, game=row[0]))
+                mutators.extend({"game": row[0], "mutator": m}
+                                for m in muts)
+            current = fingerprint(db.engine, rows[-1][0])
+            with db.engine.begin() as conn:
+                conn.execute(GameFlags.__table__.insert(), flags)
+                if mutators:
+                    conn.execute(GameMutator.__table__.insert(), mutators)
+                set_meta(conn, 'fingerprint', current)
+            watermark = rows[-1][0]
+            added += len(rows)
+    return added
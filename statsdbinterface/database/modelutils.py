@@ -1,5 +1,6 @@
 from werkzeug.exceptions import NotFound
 from flask_sqlalchemy import Pagination
+from .core import db
 
 
 def direct_to_dict(base, attributes, update=None):
@@ -36,6 +37,22 @@ def list_to_id_dict(base, attribute):
     return ret
 
 
+def count_by(key, *criterion, limit=None):
+    """
+    Return (key, number of rows) pairs for the rows matching criterion,
+    most rows first and ties by key, at most <limit>.
+    """
+
+    count = db.func.count().label('count')
+    query = (db.session.query(key, count)
+             .filter(*criterion)
+             .group_by(key)
+             .order_by(count.desc(), key))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
 def to_pagination(page, per_page, page_function, count_function):
     if page < 1 or per_page < 1:
         raise NotFound
@@ -0,0 +1,271 @@
+"""
+Daily totals by player, map, server and weapon.
+
+The rows live in the 'flags' sidecar database next to gameflags, one per
+day and key, and are extended as games arrive. Days are counted in UTC
+from the epoch, so rankings over any number of whole days sum a few rows
+per key instead of reading every game.
+"""
+import collections
+from threading import Lock
+from .core import db
+from .models import Game, GamePlayer, GameServer, GameWeapon
+from . import extmodels, gameflags
+from .. import redeclipse
+
+
+SCHEMA = gameflags.SCHEMA
+
+# Games are added in batches of this many.
+BATCH_SIZE = 10000
+
+update_lock = Lock()
+# Highest game id in the rollups.
+watermark = 0
+# Set once update() has added every game.
+complete = False
+
+
+class DailyPlayer(db.Model):
+    __tablename__ = 'daily_players'
+    __table_args__ = (
+        db.Index('daily_players_handle', 'handle', 'day'),
+        {'schema': SCHEMA},
+    )
+
+    day = db.Column(db.Integer, primary_key=True)
+    handle = db.Column(db.Text, primary_key=True)
+    games = db.Column(db.Integer)
+    # Games with more than one player, and the frags and deaths in them.
+    ranked_games = db.Column(db.Integer)
+    frags = db.Column(db.Integer)
+    deaths = db.Column(db.Integer)
+    # Ranked games with the standard weapons.
+    weapon_games = db.Column(db.Integer)
+
+
+class DailyMap(db.Model):
+    __tablename__ = 'daily_maps'
+    __table_args__ = {'schema': SCHEMA}
+
+    day = db.Column(db.Integer, primary_key=True)
+    map = db.Column(db.Text, primary_key=True)
+    games = db.Column(db.Integer)
+    # Sum of the players' timeactive.
+    time = db.Column(db.Integer)
+
+
+class DailyServer(db.Model):
+    __tablename__ = 'daily_servers'
+    __table_args__ = {'schema': SCHEMA}
+
+    day = db.Column(db.Integer, primary_key=True)
+    handle = db.Column(db.Text, primary_key=True)
+    games = db.Column(db.Integer)
+
+
+class DailyWeapon(db.Model):
+    """
+    Weapon totals of each player in games with the standard weapons.
+    """
+    __tablename__ = 'daily_weapons'
+    __table_args__ = (
+        db.Index('daily_weapons_handle', 'handle', 'day'),
+        {'schema': SCHEMA},
+    )
+
+    day = db.Column(db.Integer, primary_key=True)
+    weapon = db.Column(db.Text, primary_key=True)
+    handle = db.Column(db.Text, primary_key=True)
+
+    # Same as extmodels.Weapon.columns.
+    timewielded = db.Column(db.Integer)
+    timeloadout = db.Column(db.Integer)
+
+    damage1 = db.Column(db.Integer)
+    frags1 = db.Column(db.Integer)
+    hits1 = db.Column(db.Integer)
+    flakhits1 = db.Column(db.Integer)
+    shots1 = db.Column(db.Integer)
+    flakshots1 = db.Column(db.Integer)
+
+    damage2 = db.Column(db.Integer)
+    frags2 = db.Column(db.Integer)
+    hits2 = db.Column(db.Integer)
+    flakhits2 = db.Column(db.Integer)
+    shots2 = db.Column(db.Integer)
+    flakshots2 = db.Column(db.Integer)
+
+
+MODELS = (DailyPlayer, DailyMap, DailyServer, DailyWeapon)
+
+
+def day_of(column):
+    """
+    SQL expression, the day of the timestamp <column>.
+    """
+    return column / (24 * 60 * 60)
+
+
+def sums(model, keys, first_day, last_day, *criterion, **fields):
+    """
+    Return a Counter by key for each field, the sum of the column named by
+    the field's value from first_day to last_day inclusive.
+    """
+    columns = [getattr(model, k) for k in keys]
+    ret = {name: collections.Counter() for name in fields}
+    for row in (model.query
+                .with_entities(*columns, *[db.func.sum(getattr(model, c))
+                                           for c in fields.values()])
+                .filter(model.day >= first_day)
+                .filter(model.day <= last_day)
+                .filter(*criterion)
+                .group_by(*columns)):
+        key = row[0] if len(keys) == 1 else tuple(row[:len(keys)])
+        for name, value in zip(fields, row[len(keys):]):
+            ret[name][key] = value or 0
+    return ret
+
+
+def _collect(conn, start, end):
+    # Return (model, key names, rows) for the games start < id <= end.
+    ranked = Game.uniqueplayers > 1
+    in_range = db.and_(Game.id > start, Game.id <= end)
+    day = day_of(Game.time)
+
+    def count(condition):
+        return db.func.sum(db.case([(condition, 1)], else_=0))
+
+    def select(*columns):
+        return db.select(list(columns)).where(in_range)
+
+    players = conn.execute(
+        select(day, GamePlayer.handle, db.func.count(), count(ranked),
+               db.func.sum(db.case([(ranked, GamePlayer.frags)], else_=0)),
+               db.func.sum(db.case([(ranked, GamePlayer.deaths)], else_=0)),
+               count(db.and_(ranked, gameflags.re_normal_weapons(
+                   GamePlayer.game_id))))
+        .select_from(GamePlayer.__table__.join(Game.__table__))
+        .where(GamePlayer.handle != "")
+        .group_by(day, GamePlayer.handle)).fetchall()
+    games = dict(((d, m), n) for d, m, n in conn.execute(
+        select(day, Game.map, db.func.count())
+        .group_by(day, Game.map)))
+    playertime = dict(((d, m), t) for d, m, t in conn.execute(
+        select(day, Game.map, db.func.sum(GamePlayer.timeactive))
+        .select_from(GamePlayer.__table__.join(Game.__table__))
+        .group_by(day, Game.map)))
+    maps = [(d, m, n, playertime.get((d, m)) or 0)
+            for (d, m), n in games.items()]
+    servers = conn.execute(
+        select(day, GameServer.handle, db.func.count())
+        .select_from(GameServer.__table__.join(Game.__table__))
+        .where(GameServer.handle != "")
+        .group_by(day, GameServer.handle)).fetchall()
+    weapons = conn.execute(
+        select(day, GameWeapon.weapon, GameWeapon.playerhandle,
+               *[db.func.sum(getattr(GameWeapon, c))
+                 for c in extmodels.Weapon.columns])
+        .select_from(GameWeapon.__table__.join(Game.__table__))
+        .where(gameflags.re_normal_weapons(GameWeapon.game_id))
+        .group_by(day, GameWeapon.weapon, GameWeapon.playerhandle)
+        ).fetchall()
+    return [
+        (DailyPlayer, ['day', 'handle'], players),
+        (DailyMap, ['day', 'map'], maps),
+        (DailyServer, ['day', 'handle'], servers),
+        (DailyWeapon, ['day', 'weapon', 'handle'], weapons),
+    ]
+
+
+def _add(conn, model, keys, rows):
+    # Add rows of key values followed by the other columns to the totals.
+    # Keys start with the day, the days' existing keys are updated and the
+    # others inserted, each with a single statement.
+    if not rows:
+        return
+    table = model.__table__
+    fields = [c.name for c in table.columns if c.name not in keys]
+    existing = set(tuple(r) for r in conn.execute(
+        db.select([table.c[k] for k in keys])
+        .where(table.c.day.in_(set(row[0] for row in rows)))))
+    updates = []
+    inserts = []
+    for row in rows:
+        values = dict(zip(keys + fields,
+                          list(row[:len(keys)]) +
+                          [v or 0 for v in row[len(keys):]]))
+        if tuple(row[:len(keys)]) in existing:
+            updates.append({"_" + k: v for k, v in values.items()})
+        else:
+            inserts.append(values)
+    if updates:
+        conn.execute(
+            table.update()
+            .where(db.and_(*[table.c[k] == db.bindparam("_" + k)
+                             for k in keys]))
+            .values({f: table.c[f] + db.bindparam("_" + f)
+                     for f in fields}),
+            updates)
+    if inserts:
+        conn.execute(table.insert(), inserts)
+
+
+def setup():
+    """
+    Create the tables, clearing them if the version classes or the stats
+    database changed, and read the watermark.
+    """
+    global watermark
+    with db.engine.begin() as conn:
+        for model in MODELS + (gameflags.FlagsMeta,):
+            model.__table__.create(conn, checkfirst=True)
+        current = redeclipse.versions.signature()
+        last = int(gameflags.meta(conn, 'rollups_watermark') or 0)
+        if (gameflags.meta(conn, 'rollups_signature') != current or
+                (last and gameflags.meta(conn, 'rollups_fingerprint') !=
+                 gameflags.fingerprint(conn, last))):
+            # Standard weapons may have changed or the stats database was
+            # replaced, rebuild everything.
+            last = 0
+            for model in MODELS:
+                conn.execute(model.__table__.delete())
+            gameflags.set_meta(conn, 'rollups_signature', current)
+            gameflags.set_meta(conn, 'rollups_watermark', '0')
+            gameflags.set_meta(conn, 'rollups_fingerprint',
+                               gameflags.fingerprint(conn, 0))
+        watermark = last
+
+
+def update():
+    """
+    Add every game newer than the watermark to the daily totals, a batch
+    per transaction.
+    Return the number of games added.
+    """
+    global watermark, complete
+    added = 0
+    with update_lock:
+        setup()
+        while True:
+            ids = [r[0] for r in db.engine.execute(
+                db.select([Game.id])
+                .where(Game.id > watermark)
+                .order_by(Game.id)
+                .limit(BATCH_SIZE))]
+            if not ids:
+                break
+            # Read everything before writing, so the sidecar is not locked
+            # for writing while collecting.
+            with db.engine.begin() as conn:
+                totals = _collect(conn, watermark, ids[-1])
+                current = gameflags.fingerprint(conn, ids[-1])
+            with db.engine.begin() as conn:
+                for model, keys, rows in totals:
+                    _add(conn, model, keys, rows)
+                gameflags.set_meta(conn, 'rollups_watermark', str(ids[-1]))
+                gameflags.set_meta(conn, 'rollups_fingerprint', current)
+            watermark = ids[-1]
+            added += len(ids)
+        complete = True
+    return added
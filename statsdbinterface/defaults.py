@@ -17,3 +17,52 @@ DISPLAY_RESULTS_PER_PAGE = 15
 
 # Number of results to return in a 'recent' list.
 DISPLAY_RESULTS_RECENT = 10
+
+# Maximum number of entries held by the function cache (None for no limit).
+CACHE_MAX_ENTRIES = 10000
+
+# Approximate maximum size of the function cache in bytes (None for no limit).
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Function cache eviction policy, 'lru' or 'lfu'.
+CACHE_EVICTION = 'lru'
+
+# Minimum seconds between checks for new data, which invalidates the cache.
+CACHE_VERSION_INTERVAL = 10
+
+# Second tier for cached results, shared between processes:
+# None to only cache in memory,
+# 'disk' to keep them in interface-cache.sqlite in the data directory, so
+# they survive restarts,
+# 'memcached' to share them between servers using CACHE_MEMCACHED_SERVER.
+CACHE_BACKEND = None
+
+# Maximum size of interface-cache.sqlite in bytes (None for no limit).
+CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+
+# Memcached (or compatible) server used by the 'memcached' CACHE_BACKEND.
+# Cached results are unpickled from it, so it must be trusted.
+CACHE_MEMCACHED_SERVER = ('127.0.0.1', 11211)
+
+# Seconds between logging function cache statistics (None to disable).
+CACHE_STATS_LOG_INTERVAL = None
+
+# Accept requests while the precache is built in the background, instead of
+# building it before starting. /api/ready returns 503 until it is finished.
+BACKGROUND_WARMUP = False
+
+# Keep the precache in interface-precache.bin in the data directory, so a
+# restart only processes the games added since. Processes share its pages.
+PRECACHE_SNAPSHOT = True
+
+# Number of threads computing the dashboard rankings concurrently.
+RANKING_WORKERS = 4
+
+# Seconds to wait for the dashboard rankings, slower ones show their last
+# cached results (or nothing) while they finish in the background.
+RANKING_TIMEOUT = 10
+
+# Seconds between recomputing the dashboard, modes and mutators rankings in
+# the background, they are also recomputed when new data arrives.
+# None to only compute them when requested.
+SCHEDULER_INTERVAL = 10 * 60
@@ -1,67 +1,448 @@
+import sys
 import time
-from threading import Thread, Lock
+import logging
+import queue
+import traceback
+from collections import OrderedDict
+from threading import Thread, Lock, Event
 import atexit
-cache = {}
+# Ordered from least to most recently used.
+cache = OrderedDict()
 cache_cleaner_thread = None
 cache_lock = Lock()
 cache_cleaner_running = False
+# App used to provide a context to background refreshes.
+cache_app = None
+# Stale entries waiting to be recomputed by refresher().
+refresh_queue = queue.Queue()
+refresh_thread = None
+refresh_running = False
+# Keys currently being computed, mapped to their Flight.
+inflight = {}
+# Number of computations avoided by waiting on an in-flight key.
+deduplicated = 0
+# Number of entries removed to stay within the limits.
+evicted = 0
+# Approximate size of all cached results.
+cache_bytes = 0
+# Counters for each cached function, by function name.
+function_stats = {}
 
+# Limits, changed by setup(). None disables a limit.
+max_entries = 10000
+max_bytes = 64 * 1024 * 1024
+# Either 'lru' or 'lfu'.
+eviction = 'lru'
 
-def cached(seconds, cattr=None):
+# Callable returning the current data version, set by setup().
+version_source = None
+# Minimum number of seconds between calls to version_source.
+version_interval = 10
+version_lock = Lock()
+current_version = None
+version_sampled = 0
+
+# Optional shared cache_backends.Backend tier, set by setup().
+backend = None
+
+# Seconds between logging stats(), None disables logging.
+log_interval = None
+log_last = 0
+
+
+class Flight:
+    """
+    A single in-progress computation that other callers can wait on.
+    """
+
+    def __init__(self):
+        self.event = Event()
+        self.results = None
+        self.exception = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.results
+
+
+class Entry:
+    """
+    A cached result and its bookkeeping.
+    """
+    __slots__ = ['created', 'results', 'seconds', 'stale', 'version',
+                 'size', 'hits']
+
+    def __init__(self, results, seconds, stale=0, version=None,
+                 created=None):
+        self.created = created or time.time()
+        self.results = results
+        self.seconds = seconds
+        self.stale = stale
+        self.version = version
+        self.size = sizeof(results)
+        self.hits = 0
+
+    def fresh(self, now=None, version=None):
+        # Entries are fresh until the data changes, at most seconds long.
+        if version is not None and self.version != version:
+            return False
+        return (now or time.time()) - self.created < self.seconds
+
+    def expired(self, now=None):
+        # Stale entries may still be served until this returns True.
+        return ((now or time.time()) - self.created >=
+                self.seconds + self.stale)
+
+
+def sizeof(obj, depth=4):
+    """
+    Return the approximate size of obj in bytes, following containers.
+    """
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += sizeof(k, depth - 1) + sizeof(v, depth - 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += sizeof(v, depth - 1)
+    elif hasattr(obj, '__dict__'):
+        size += sizeof(vars(obj), depth - 1)
+    return size
+
+
+def data_version():
+    """
+    Return the current data version, sampling version_source at most once
+    every version_interval seconds.
+    """
+    global current_version, version_sampled
+    if version_source is None:
+        return None
+    now = time.time()
+    if now - version_sampled < version_interval:
+        return current_version
+    # Only one thread samples, the others use the previous version.
+    if not version_lock.acquire(blocking=False):
+        return current_version
+    try:
+        version_sampled = now
+        version = version_source()
+        if version is not None:
+            current_version = version
+    except Exception:
+        traceback.print_exc()
+    finally:
+        version_lock.release()
+    return current_version
+
+
+def _stats(name):
+    # Return the counters for a function, cache_lock must be held.
+    if name not in function_stats:
+        function_stats[name] = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "deduplicated": 0,
+            "backend_hits": 0,
+            "computes": 0,
+            "compute_time": 0,
+            "entries": 0,
+            "bytes": 0,
+        }
+    return function_stats[name]
+
+
+def _remove(key):
+    # Remove key from the cache, cache_lock must be held.
+    global cache_bytes
+    entry = cache.pop(key)
+    cache_bytes -= entry.size
+    fstats = _stats(key[0])
+    fstats["entries"] -= 1
+    fstats["bytes"] -= entry.size
+    return entry
+
+
+def _victim(fid=None, exclude=None):
+    # Choose a key to evict, optionally only from one function.
+    # cache_lock must be held.
+    keys = (k for k in cache
+            if (fid is None or k[0] == fid) and k != exclude)
+    if eviction == 'lfu':
+        return min(keys, key=lambda k: cache[k].hits, default=None)
+    return next(keys, None)
+
+
+def _insert(key, entry, quota):
+    # Store entry under key and evict to stay within the limits.
+    # cache_lock must be held.
+    global cache_bytes, evicted
+    if key in cache:
+        _remove(key)
+    fid = key[0]
+    fstats = _stats(fid)
+    if quota is not None:
+        while fstats["entries"] >= quota:
+            _remove(_victim(fid))
+            evicted += 1
+    cache[key] = entry
+    cache_bytes += entry.size
+    fstats["entries"] += 1
+    fstats["bytes"] += entry.size
+    while len(cache) > 1 and (
+            (max_entries is not None and len(cache) > max_entries) or
+            (max_bytes is not None and cache_bytes > max_bytes)):
+        # Never evict the entry just stored.
+        _remove(_victim(exclude=key))
+        evicted += 1
+
+
+def _compute(key, flight, f, args, kwargs, seconds, maxentries, stale):
+    # Run f for the in-flight key and store the results.
+    try:
+        # Tag with the version from before computing, so changes made
+        # during the computation cause a later refresh.
+        version = data_version()
+        stored = (backend.get(key, version)
+                  if backend is not None else None)
+        if stored is not None:
+            created, flight.results = stored
+            entry = Entry(flight.results, seconds, stale, version, created)
+            with cache_lock:
+                _stats(key[0])["backend_hits"] += 1
+        else:
+            start = time.time()
+            flight.results = f(*args, **kwargs)
+            elapsed = time.time() - start
+            entry = Entry(flight.results, seconds, stale, version)
+            with cache_lock:
+                fstats = _stats(key[0])
+                fstats["computes"] += 1
+                fstats["compute_time"] += elapsed
+            if backend is not None:
+                backend.put(key, version, entry.created, seconds,
+                            flight.results)
+    except Exception as e:
+        flight.exception = e
+        raise
+    else:
+        with cache_lock:
+            _insert(key, entry, maxentries)
+    finally:
+        with cache_lock:
+            inflight.pop(key, None)
+        flight.event.set()
+    return flight.results
+
+
+def cached(seconds, cattr=None, maxentries=None, stale_ttl=None):
     """
     Decorator, registers function to the cache.
+    Entries are invalidated when the data version changes, seconds is an
+    upper bound on their lifetime.
+    Concurrent callers of a missing key share a single computation.
+    maxentries limits the number of entries this function may hold.
+    With stale_ttl, results up to stale_ttl seconds past their expiry are
+    returned immediately while refresher() recomputes them.
+    The decorated function's peek() returns the stored results for its
+    arguments, however old, without computing them, and refresh() computes
+    and stores them even if they are fresh.
     """
+    stale = stale_ttl or 0
+
     def wrapper(f):
-        def function(*args, **kwargs):
-            # Construct key from the function id and arguments.
+        name = '%s.%s' % (f.__module__, f.__qualname__)
+
+        def make_key(args, kwargs):
+            # Construct key from the function name and arguments, it must
+            # stay the same between processes for the backend.
             if cattr is None:
-                key = (id(f), args, tuple(kwargs.items()))
-            else:
-                # Used for class methods, change args[0] to an attribute.
-                kargs = args[1:]
-                key = (id(f), id(type(args[0])),
-                       getattr(args[0], cattr), kargs,
-                       tuple(kwargs.items()))
-            needresults = False
+                return (name, args, tuple(kwargs.items()))
+            # Used for class methods, change args[0] to an attribute.
+            kargs = args[1:]
+            return (name, type(args[0]).__qualname__,
+                    getattr(args[0], cattr), kargs,
+                    tuple(kwargs.items()))
+
+        def function(*args, **kwargs):
+            global deduplicated
+            key = make_key(args, kwargs)
+            version = data_version()
+            with cache_lock:
+                entry = cache.get(key)
+                if entry is not None:
+                    now = time.time()
+                    fresh = entry.fresh(now, version)
+                    if fresh or (entry.stale and refresh_running and
+                                 not entry.expired(now)):
+                        _stats(name)["hits" if fresh else "stale_hits"] += 1
+                        entry.hits += 1
+                        cache.move_to_end(key)
+                        if not fresh and key not in inflight:
+                            # Serve the stale value and refresh it later.
+                            inflight[key] = Flight()
+                            refresh_queue.put((key, inflight[key], f, args,
+                                               kwargs, seconds, maxentries,
+                                               stale))
+                        return entry.results
+                    if entry.expired(now):
+                        _remove(key)
+                    # Otherwise peek() may still return it until the new
+                    # results replace it.
+                fstats = _stats(name)
+                fstats["misses"] += 1
+                flight = inflight.get(key)
+                if flight is not None:
+                    deduplicated += 1
+                    fstats["deduplicated"] += 1
+                    owner = False
+                else:
+                    flight = inflight[key] = Flight()
+                    owner = True
+            if not owner:
+                return flight.wait()
+            return _compute(key, flight, f, args, kwargs,
+                            seconds, maxentries, stale)
+
+        def peek(*args, **kwargs):
+            with cache_lock:
+                entry = cache.get(make_key(args, kwargs))
+                return entry.results if entry is not None else None
+
+        def refresh(*args, **kwargs):
+            # Recompute and store the results, even if they are fresh.
+            key = make_key(args, kwargs)
             with cache_lock:
-                if key not in cache:
-                    needresults = True
-            if needresults:
-                results = f(*args, **kwargs)
-                with cache_lock:
-                    cache[key] = (time.time(), results, seconds)
-            return cache[key][1]
+                flight = inflight.get(key)
+                owner = flight is None
+                if owner:
+                    flight = inflight[key] = Flight()
+            if not owner:
+                return flight.wait()
+            return _compute(key, flight, f, args, kwargs,
+                            seconds, maxentries, stale)
+
+        function.peek = peek
+        function.refresh = refresh
         return function
 
     return wrapper
 
 
+def stats():
+    """
+    Return a dict describing the current cache state.
+    """
+    with cache_lock:
+        return {
+            "entries": len(cache),
+            "bytes": cache_bytes,
+            "max_entries": max_entries,
+            "max_bytes": max_bytes,
+            "eviction": eviction,
+            "evicted": evicted,
+            "inflight": len(inflight),
+            "deduplicated": deduplicated,
+            "version": current_version,
+            "backend": backend.stats() if backend is not None else None,
+            "functions": {name: dict(fstats) for name, fstats
+                          in function_stats.items()},
+        }
+
+
+def log_stats():
+    """
+    Log a summary of stats() for each function.
+    """
+    logger = logging.getLogger(__name__)
+    current = stats()
+    logger.info("Cache: %d entries, %d bytes, %d evicted, %d deduplicated.",
+                current["entries"], current["bytes"], current["evicted"],
+                current["deduplicated"])
+    for name, fstats in sorted(current["functions"].items()):
+        logger.info("Cache %s: %d hits, %d stale, %d misses, %d computed "
+                    "in %.3fs, %d entries, %d bytes.", name,
+                    fstats["hits"], fstats["stale_hits"], fstats["misses"],
+                    fstats["computes"], fstats["compute_time"],
+                    fstats["entries"], fstats["bytes"])
+
+
 def cleaner():
+    global log_last
     while cache_cleaner_running:
         # Clean every minute, but periodically test for exit.
         for i in range(0, 60 * 10):
             time.sleep(0.1)
             if not cache_cleaner_running:
                 return
-        todelete = []
-        for key in cache:
-            if time.time() - cache[key][0] >= cache[key][2]:
-                todelete.append(key)
-        for key in todelete:
-            with cache_lock:
-                cache.pop(key)
+        with cache_lock:
+            now = time.time()
+            for key in [k for k in cache if cache[k].expired(now)]:
+                _remove(key)
+        if log_interval is not None and now - log_last >= log_interval:
+            log_last = now
+            log_stats()
+
+
+def refresher():
+    while refresh_running:
+        try:
+            job = refresh_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        try:
+            if cache_app is not None:
+                with cache_app.app_context():
+                    _compute(*job)
+            else:
+                _compute(*job)
+        except Exception:
+            # Keep serving the stale value, the next hit retries.
+            traceback.print_exc()
 
 
 def cancel_cleaner():
-    global cache_cleaner_running
+    global cache_cleaner_running, refresh_running
     cache_cleaner_running = False
+    refresh_running = False
 
 
-def setup():
+def setup(app=None, version=None):
+    """
+    Apply limits from the app config and start the cache threads.
+    version is a callable returning the current data version.
+    """
     global cache_cleaner_running, cache_cleaner_thread
+    global refresh_running, refresh_thread, cache_app
+    global max_entries, max_bytes, eviction
+    global version_source, version_interval, backend, log_interval
+    if version is not None:
+        version_source = version
+    if app is not None:
+        cache_app = app
+        config = app.config
+        version_interval = config.get('CACHE_VERSION_INTERVAL',
+                                      version_interval)
+        max_entries = config.get('CACHE_MAX_ENTRIES', max_entries)
+        max_bytes = config.get('CACHE_MAX_BYTES', max_bytes)
+        eviction = config.get('CACHE_EVICTION', eviction)
+        log_interval = config.get('CACHE_STATS_LOG_INTERVAL', log_interval)
+        assert eviction in ('lru', 'lfu'), (
+            "CACHE_EVICTION must be 'lru' or 'lfu', not %r." % eviction)
+        if backend is None:
+            from .cache_backends import from_config
+            backend = from_config(config)
     if cache_cleaner_running:
         return
     cache_cleaner_thread = Thread(target=cleaner, daemon=True)
     cache_cleaner_running = True
     cache_cleaner_thread.start()
+    refresh_thread = Thread(target=refresher, daemon=True)
+    refresh_running = True
+    refresh_thread.start()
     atexit.register(cancel_cleaner)
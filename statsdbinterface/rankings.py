@@ -1,356 +1,614 @@
+import collections
+import concurrent.futures
+import heapq
 import time
-from .database import models, extmodels
+from threading import Lock
+from flask import current_app
+from .database import models, extmodels, gameflags, rollups
 from .database.core import db
 from .function_cache import cached
+from .sliding import sliding
 from . import redeclipse
 
+# Rankings are refreshed when new games arrive, or after this long as games
+# leave their window.
+MAX_AGE = 60 * 60
 
-def days_ago(days):
-    return time.time() - (days * 60 * 60 * 24)
+# Rankings may be served this long past expiry while they are refreshed.
+STALE_TTL = 24 * 60 * 60
 
 
-@cached(60)
-def first_game_in_days(days):
+# Pool running compute_all() jobs, created on first use.
+pool = None
+pool_lock = Lock()
+
+
+# Windows end at a multiple of this many seconds unless told otherwise, so
+# their cache keys only change once per period.
+WINDOW_ALIGN = 60
+
+
+def window(days, align=WINDOW_ALIGN):
+    """
+    Return (start, end) of the last <days> days, ending at the most recent
+    multiple of <align> seconds.
+    """
+    end = int(time.time()) // align * align
+    return end - int(days * 60 * 60 * 24), end
+
+
+@cached(MAX_AGE, maxentries=100)
+def first_game_since(start):
     return (
         (models.Game.query
          .with_entities(db.func.min(models.Game.id))
-         .filter(models.Game.time >= days_ago(days))).scalar() or
-        (models.Game.query
-         .with_entities(db.func.max(models.Game.id)).scalar() + 1)
+         .filter(models.Game.time >= start)).scalar() or
+        ((models.Game.query
+          .with_entities(db.func.max(models.Game.id)).scalar() or 0) + 1)
         )
 
 
-def weapon_sums(days, use_totalwielded=True):
-    first_game = first_game_in_days(days)
-    totalwielded = 0
-    if use_totalwielded:
-        totalwielded = (models.GameWeapon.query
-                        .with_entities(db.func.sum(
-                            models.GameWeapon.timewielded))
-                        .filter(models.GameWeapon.game_id >= first_game)
-                        .filter(db.func.re_normal_weapons(
-                            models.GameWeapon.game_id))
-                        .filter(models.GameWeapon.weapon.in_(
-                            redeclipse.versions.default.standardweaponlist))
-                        .first()[0])
-    weapons = extmodels.Weapon.all_from_f((
-        models.GameWeapon.game_id >= first_game,
-        db.func.re_normal_weapons(models.GameWeapon.game_id),
-        models.GameWeapon.weapon.in_(
-            redeclipse.versions.default.standardweaponlist)))
+def first_game_in_days(days, align=WINDOW_ALIGN):
+    return first_game_since(window(days, align)[0])
+
+
+def _game_hours(start, end):
+    # Count games between start and end by (ISO weekday, hour).
+    counts = collections.Counter()
+    for (t,) in (models.Game.query
+                 .with_entities(models.Game.time)
+                 .filter(models.Game.id >= first_game_since(start))
+                 .filter(models.Game.time < end)):
+        gmtime = time.gmtime(t)
+        counts[(gmtime.tm_wday + 1, gmtime.tm_hour)] += 1
+    return counts
+
+
+# The last window counted by game_hours_between, by its length.
+_game_hours_previous = {}
+
+
+def game_hours(days, align):
+    """
+    Return a Counter of games by (ISO weekday, hour) over the last <days>
+    days, ending at the most recent multiple of <align> seconds.
+    """
+    return game_hours_between(*window(days, align))
+
+
+@cached(MAX_AGE, maxentries=10)
+def game_hours_between(start, end):
+    """
+    Return a Counter of games by (ISO weekday, hour) between start and end.
+    Games are recorded when they end, so the previous window of the same
+    length is extended by the periods that entered and left it instead of
+    being recounted.
+    """
+    previous = _game_hours_previous.get(end - start)
+    if previous is not None and 0 <= end - previous[1] < end - start:
+        pstart, pend, counts = previous
+        counts = counts + _game_hours(pend, end)
+        counts.subtract(_game_hours(pstart, start))
+        counts = +counts
+    else:
+        counts = _game_hours(start, end)
+    _game_hours_previous[end - start] = (start, end, counts)
+    return counts
+
+
+def _between(column, start, end):
+    return db.and_(column >= start, column < end)
+
+
+def _sums(query, keys, **fields):
+    # Return a Counter by key for each of the aggregate fields, with the
+    # query grouped by keys.
+    sums = {name: collections.Counter() for name in fields}
+    for row in query.with_entities(*keys, *fields.values()).group_by(*keys):
+        key = row[0] if len(keys) == 1 else tuple(row[:len(keys)])
+        for name, value in zip(fields, row[len(keys):]):
+            sums[name][key] = value or 0
+    return sums
+
+
+def window_sums(totals, days):
+    """
+    Return the sliding.SlidingSums <totals> over the last <days> days.
+    """
+    return totals.sums(days, first_game_in_days(days))
+
+
+@sliding
+def weapon_totals(start, end):
+    return _sums(models.GameWeapon.query
+                 .filter(_between(models.GameWeapon.game_id, start, end))
+                 .filter(gameflags.re_normal_weapons(
+                     models.GameWeapon.game_id))
+                 .filter(models.GameWeapon.weapon.in_(
+                     redeclipse.versions.default.standardweaponlist)),
+                 [models.GameWeapon.weapon],
+                 **{c: db.func.sum(getattr(models.GameWeapon, c))
+                    for c in extmodels.Weapon.columns})
+
+
+@sliding
+def map_totals(start, end):
+    sums = _sums(models.Game.query
+                 .filter(_between(models.Game.id, start, end)),
+                 [models.Game.map], games=db.func.count())
+    sums.update(_sums(models.GamePlayer.query.join(models.Game)
+                      .filter(_between(models.GamePlayer.game_id,
+                                       start, end)),
+                      [models.Game.map],
+                      time=db.func.sum(models.GamePlayer.timeactive)))
+    return sums
+
+
+@sliding
+def player_games(start, end):
+    return _sums(models.GamePlayer.query
+                 .filter(_between(models.GamePlayer.game_id, start, end))
+                 .filter(models.GamePlayer.handle != ""),
+                 [models.GamePlayer.handle], games=db.func.count())
+
+
+@sliding
+def server_games(start, end):
+    return _sums(models.GameServer.query
+                 .filter(_between(models.GameServer.game_id, start, end))
+                 .filter(models.GameServer.handle != ""),
+                 [models.GameServer.handle], games=db.func.count())
+
+
+@sliding
+def mode_games(start, end):
+    return _sums(models.Game.query.outerjoin(models.GameServer)
+                 .filter(_between(models.Game.id, start, end)),
+                 [models.Game.mode, models.Game.mutators,
+                  models.GameServer.version],
+                 games=db.func.count())
+
+
+@sliding
+def player_frags(start, end):
+    return _sums(models.GamePlayer.query.join(models.Game)
+                 .filter(_between(models.GamePlayer.game_id, start, end))
+                 .filter(models.GamePlayer.handle != "")
+                 .filter(models.Game.uniqueplayers > 1),
+                 [models.GamePlayer.handle],
+                 games=db.func.count(),
+                 frags=db.func.sum(models.GamePlayer.frags),
+                 deaths=db.func.sum(models.GamePlayer.deaths))
+
+
+@sliding
+def player_weapon_totals(start, end):
+    sums = _sums(models.GamePlayer.query.join(models.Game)
+                 .filter(_between(models.GamePlayer.game_id, start, end))
+                 .filter(models.GamePlayer.handle != "")
+                 .filter(gameflags.re_normal_weapons(
+                     models.GamePlayer.game_id))
+                 .filter(models.Game.uniqueplayers > 1),
+                 [models.GamePlayer.handle], games=db.func.count())
+    sums.update(_sums(models.GameWeapon.query
+                      .filter(_between(models.GameWeapon.game_id,
+                                       start, end))
+                      .filter(gameflags.re_normal_weapons(
+                          models.GameWeapon.game_id))
+                      .filter(~models.GameWeapon.weapon.in_(
+                          redeclipse.versions.default.notwielded)),
+                      [models.GameWeapon.playerhandle],
+                      damage1=db.func.sum(models.GameWeapon.damage1),
+                      damage2=db.func.sum(models.GameWeapon.damage2),
+                      timewielded=db.func.sum(
+                          models.GameWeapon.timewielded),
+                      frags1=db.func.sum(models.GameWeapon.frags1),
+                      frags2=db.func.sum(models.GameWeapon.frags2)))
+    return sums
+
+
+def _top(items, key, limit=None, reverse=False):
+    """
+    Return items sorted by key, or the first <limit> of them selected with
+    a heap instead of sorting them all.
+    """
+    if limit is None:
+        return sorted(items, key=key, reverse=reverse)
+    if reverse:
+        return heapq.nlargest(limit, items, key=key)
+    return heapq.nsmallest(limit, items, key=key)
+
+
+def _weapon_sums(sums, use_totalwielded=True):
+    # Weapon objects from the weapon_totals fields.
+    weapons = []
+    for name in extmodels.Weapon.weapon_list():
+        weapon = extmodels.Weapon(name)
+        for c in extmodels.Weapon.columns:
+            setattr(weapon, c, sums[c][name])
+        weapons.append(weapon)
     return {
          "weapons": weapons,
-         "totalwielded": totalwielded or 0,
+         "totalwielded": (sum(sums["timewielded"].values())
+                          if use_totalwielded else 0),
          }
 
 
-@cached(15 * 60)
-def weapons_by_wielded(days):
-    """
-    Return weapons sorted by wielded ratio.
-    Cache can be high, result will not change quickly.
-    """
-    res = weapon_sums(days)
-    ret = sorted(res["weapons"], key=lambda w: w.timewielded, reverse=True)
+def _weapons_by_wielded(res, limit=None):
+    ret = _top(res["weapons"], lambda w: w.timewielded, limit, True)
     return [{"name": w.name, "timewielded":
              w.timewielded / max(1, res["totalwielded"])} for w in ret]
 
 
-@cached(15 * 60)
-def weapons_by_dpm(days):
-    """
-    Return weapons sorted by DPM.
-    Cache can be high, result will not change quickly.
-    """
-    res = weapon_sums(days, False)
+def _weapons_by_dpm(res, limit=None):
     mintime = sum([w.time() for w in res["weapons"]]) / len(res["weapons"]) / 4
-    ret = sorted([w for w in res["weapons"] if w.time() >= mintime],
-                 key=lambda w: (w.damage1 + w.damage2) /
-                 (max(1, w.time()) / 60), reverse=True)
+    ret = _top([w for w in res["weapons"] if w.time() >= mintime],
+               lambda w: (w.damage1 + w.damage2) / (max(1, w.time()) / 60),
+               limit, True)
     return [{"name": w.name, "dpm": (w.damage1 + w.damage2) /
              (max(1, w.time()) / 60)} for w in ret]
 
 
-@cached(60 * 3)
-def maps_by_playertime(days):
+def _maps_by_playertime(sums, limit=None):
+    ret = []
+    for map_, games in sums["games"].items():
+        if games:
+            ret.append({
+                "name": map_,
+                "time": sums["time"][map_],
+                "games": games,
+                })
+    return _top(ret, lambda m: m['time'], limit, True)
+
+
+def _by_games(games, limit=None):
+    return [{"handle": handle, "games": games[handle]}
+            for handle in _top((h for h in games if games[h]),
+                               lambda h: (-games[h], h), limit)]
+
+
+def _players_by_kdr(sums, limit=None):
+    ret = {}
+    games = {}
+    for handle, count in sums["games"].items():
+        if count:
+            ret[handle] = {
+                "handle": handle,
+                "frags": sums["frags"][handle],
+                "deaths": sums["deaths"][handle],
+                }
+            games[handle] = count
+    # Only count players who have played >= half the average number of games.
+    # This avoids small numbers of games from skewing the values.
+    gamemin = min([sum(games.values()) / max(1, len(games)) / 2,
+                   max(games.values()) if games else 0])
+    for h in ret:
+        ret[h]['kdr'] = ret[h]['frags'] / max(1, ret[h]['deaths'])
+    return [ret[h] for h in _top([p for p in ret if games[p] >= gamemin],
+                                 lambda p: ret[p]['kdr'], limit, True)]
+
+
+def _player_damage(sums):
+    players = {}
+    for handle, count in sums["games"].items():
+        if count:
+            players[handle] = {
+                "games": count,
+                "damage": sums["damage1"][handle] + sums["damage2"][handle],
+                "timewielded": sums["timewielded"][handle],
+                "frags": sums["frags1"][handle] + sums["frags2"][handle],
+                }
+    # Only count players who have played >= half the average number of games.
+    # This avoids small numbers of games from skewing the values.
+    counts = [p["games"] for p in players.values()]
+    gamemin = min([sum(counts) / max(len(counts), 1) / 2,
+                   max(counts) if counts else 0])
+    return {
+        "players": players,
+        "gamemin": gamemin,
+        }
+
+
+def _players_by_dpm(totals, limit=None):
+    ret = [{
+        "handle": handle,
+        "dpm": p["damage"] / (max(p["timewielded"], 1) / 60),
+        } for handle, p in totals["players"].items()
+        if p["games"] >= totals["gamemin"]]
+    return _top(ret, lambda p: p['dpm'], limit, True)
+
+
+def _players_by_dpf(totals, limit=None, reverse=False):
+    ret = [{
+        "handle": handle,
+        "dpf": p["damage"] / max(p["frags"], 1),
+        } for handle, p in totals["players"].items()
+        if p["games"] >= totals["gamemin"]]
+    return _top(ret, lambda p: p['dpf'], limit, reverse)
+
+
+def weapon_sums(days, use_totalwielded=True):
+    return _weapon_sums(window_sums(weapon_totals, days), use_totalwielded)
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def weapons_by_wielded(days, limit=None):
     """
-    Return maps sorted by their player time.
-    Cache should be low, result could change quickly.
+    Return weapons sorted by wielded ratio, at most <limit>.
     """
-    first_game = first_game_in_days(days)
-    maps = [r[0] for r in models.Game.query
-            .with_entities(models.Game.map)
-            .filter(models.Game.time >= days_ago(days))]
-    ret = []
-    for map_ in set(maps):
-        ret.append({
-            "name": map_,
-            "time": (models.GamePlayer.query
-                     .join(models.Game)
-                     .with_entities(db.func.sum(models.GamePlayer.timeactive))
-                     .filter(models.GamePlayer.game_id >= first_game)
-                     .filter(models.Game.map == map_)
-                     .first()[0]),
-            "games": maps.count(map_),
-            })
-    return sorted(ret, key=lambda m: m['time'], reverse=True)
+    return _weapons_by_wielded(weapon_sums(days), limit)
 
 
-@cached(60)
-def players_by_games(days):
-    first_game = first_game_in_days(days)
-    players = [r[0] for r in models.GamePlayer.query
-               .with_entities(models.GamePlayer.handle)
-               .filter(models.GamePlayer.game_id >= first_game)
-               .filter(models.GamePlayer.handle != "")]
-    ret = []
-    for player in set(players):
-        ret.append({
-            "handle": player,
-            "games": players.count(player),
-            })
-    return sorted(ret, key=lambda p: p['games'], reverse=True)
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def weapons_by_dpm(days, limit=None):
+    """
+    Return weapons sorted by DPM, at most <limit>.
+    """
+    return _weapons_by_dpm(weapon_sums(days, False), limit)
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def maps_by_playertime(days, limit=None):
+    """
+    Return maps sorted by their player time, at most <limit>.
+    """
+    return _maps_by_playertime(window_sums(map_totals, days), limit)
 
 
-@cached(60)
-def modes_by_games(days):
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def players_by_games(days, limit=None):
+    return _by_games(window_sums(player_games, days)["games"], limit)
+
+
+@cached(MAX_AGE)
+def mode_mutator_games(days):
+    """
+    Return Counters of games by mode and by mutator, with gsp mutators
+    counted both by name and as mode-mutator.
+    Each distinct (mode, mutators, version) is decoded once.
+    Not served stale, refreshing modes_by_games and mutators_by_games must
+    recompute it.
+    """
+    modes = collections.Counter()
+    mutators = collections.Counter()
+    for (mode, mutmask, version), games in window_sums(
+            mode_games, days)["games"].items():
+        flags, muts = gameflags.decode(mode, mutmask, version)
+        modes[flags["mode"]] += games
+        for mut in muts:
+            mutators[mut] += games
+            mutators["%s-%s" % (flags["mode"], mut)] += games
+    return modes, mutators
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def modes_by_games(days, limit=None):
     re = redeclipse.versions.default
-    first_game = first_game_in_days(days)
-    modes = extmodels.Mode.mode_list()
+    games = mode_mutator_games(days)[0]
     ret = []
-    for mode in modes:
-        m = {
+    for mode in extmodels.Mode.mode_list():
+        ret.append({
             'name': mode,
             'longname': re.modestr[re.modes[mode]],
-            'games': 0,
-            }
-        m['games'] = models.Game.query.filter(
-            db.func.re_mode(models.Game.id, mode),
-            models.Game.id >= first_game
-            ).count()
-        ret.append(m)
-    return sorted(ret, key=lambda m: m['games'], reverse=True)
-
-
-@cached(60)
-def mutators_by_games(days):
-    first_game = first_game_in_days(days)
-    mutators = extmodels.Mutator.mutator_list()
+            'games': games[mode],
+            })
+    return _top(ret, lambda m: m['games'], limit, True)
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def mutators_by_games(days, limit=None):
+    games = mode_mutator_games(days)[1]
     ret = []
-    for mutator in mutators:
-        m = {
+    for mutator in extmodels.Mutator.mutator_list():
+        ret.append({
             'name': mutator,
             'link': mutator,
             'longname': mutator,
-            'games': 0,
-            }
-        if '-' in mutator:
-            mode, mut = mutator.split('-')
-            m['games'] = models.Game.query.filter(
-                db.func.re_mode(models.Game.id, mode),
-                db.func.re_mut(models.Game.id, mut),
-                models.Game.id >= first_game
-                ).count()
-        else:
-            m['games'] = models.Game.query.filter(
-                db.func.re_mut(models.Game.id, mutator),
-                models.Game.id >= first_game
-                ).count()
-        ret.append(m)
-    return sorted(ret, key=lambda m: m['games'], reverse=True)
-
-
-@cached(60)
-def servers_by_games(days):
-    first_game = first_game_in_days(days)
-    servers = [r[0] for r in models.GameServer.query
-               .with_entities(models.GameServer.handle)
-               .filter(models.GameServer.game_id >= first_game)
-               .filter(models.GameServer.handle != "")]
-    ret = []
-    for server in set(servers):
-        ret.append({
-            "handle": server,
-            "games": servers.count(server),
+            'games': games[mutator],
             })
-    return sorted(ret, key=lambda p: p['games'], reverse=True)
+    return _top(ret, lambda m: m['games'], limit, True)
 
 
-@cached(60)
-def players_by_kdr(days):
-    first_game = first_game_in_days(days)
-    ret = {}
-    games = {}
-    for player in (models.GamePlayer.query.join(models.Game)
-                   .filter(models.GamePlayer.game_id >= first_game)
-                   .filter(models.GamePlayer.handle != "")
-                   .filter(models.Game.uniqueplayers > 1)):
-        if player.handle not in ret:
-            ret[player.handle] = {
-                "handle": player.handle,
-                "frags": 0,
-                "deaths": 0,
-                }
-            games[player.handle] = 0
-        games[player.handle] += 1
-        ret[player.handle]["frags"] += player.frags
-        ret[player.handle]["deaths"] += player.deaths
-    # Only count players who have played >= half the average number of games.
-    # This avoids small numbers of games from skewing the values.
-    gamemin = min([sum(games.values()) / max(1, len(games)) / 2,
-                   max(games.values()) if games else 0])
-    for h in ret:
-        ret[h]['kdr'] = ret[h]['frags'] / max(1, ret[h]['deaths'])
-    return [ret[h] for h in sorted([p for p in ret if games[p] >= gamemin],
-                                   key=lambda p: ret[p]['kdr'],
-                                   reverse=True)]
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def servers_by_games(days, limit=None):
+    return _by_games(window_sums(server_games, days)["games"], limit)
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def players_by_kdr(days, limit=None):
+    return _players_by_kdr(window_sums(player_frags, days), limit)
 
 
-@cached(5 * 60)
-def players_by_dpm(days):
+@cached(MAX_AGE)
+def player_damage(days):
     """
-    Return a sorted list of players with and by dpm.
+    Return damage totals by player handle, and the minimum number of games
+    a player needs to be ranked by them.
+    Not served stale, refreshing players_by_dpm and players_by_dpf must
+    recompute it.
     """
-    first_game = first_game_in_days(days)
-    res_compiled = {}
-    games = {}
-    for player in (models.GamePlayer.query.join(models.Game)
-                   .with_entities(models.GamePlayer.handle)
-                   .filter(models.GamePlayer.game_id >= first_game)
-                   .filter(models.GamePlayer.handle != "")
-                   .filter(db.func.re_normal_weapons(
-                       models.GamePlayer.game_id))
-                   .filter(models.Game.uniqueplayers > 1)):
-        if player.handle not in games:
-            games[player.handle] = 0
-        games[player.handle] += 1
-    for player in games.keys():
-        d1, d2, timewielded = (
-            models.GameWeapon.query
-            .with_entities(db.func.sum(models.GameWeapon.damage1),
-                           db.func.sum(models.GameWeapon.damage2),
-                           db.func.sum(models.GameWeapon.timewielded))
-            .filter(models.GameWeapon.playerhandle == player)
-            .filter(models.GameWeapon.game_id >= first_game)
-            .filter(db.func.re_normal_weapons(models.GameWeapon.game_id))
-            .filter(~models.GameWeapon.weapon.in_(
-                redeclipse.versions.default.notwielded
-                ))).first()
-        res_compiled[player] = {
-            "handle": player,
-            "dpm": (((d1 or 0) + (d2 or 0)) / (max(timewielded or 0, 1) / 60)),
-            }
-    # Only count players who have played >= half the average number of games.
-    # This avoids small numbers of games from skewing the values.
-    gamemin = min([sum(games.values()) / max(len(games), 1) / 2,
-                   games and max(games.values()) or 0])
-    return [res_compiled[p] for p in sorted([p for p in res_compiled
-                                             if games[p] >= gamemin],
-                                            key=lambda p:
-                                                res_compiled[p]['dpm'],
-                                            reverse=True)]
+    return _player_damage(window_sums(player_weapon_totals, days))
 
 
-@cached(5 * 60)
-def players_by_dpf(days):
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def players_by_dpm(days, limit=None):
     """
-    Return a sorted list of players with and by dpf.
+    Return a sorted list of players with and by dpm, at most <limit>.
+    Players with fewer than player_damage(days)['gamemin'] games are left
+    out.
     """
-    first_game = first_game_in_days(days)
-    res_compiled = {}
-    games = {}
-    for player in (models.GamePlayer.query.join(models.Game)
-                   .with_entities(models.GamePlayer.handle)
-                   .filter(models.GamePlayer.game_id >= first_game)
-                   .filter(models.GamePlayer.handle != "")
-                   .filter(db.func.re_normal_weapons(
-                       models.GamePlayer.game_id))
-                   .filter(models.Game.uniqueplayers > 1)):
-        if player.handle not in games:
-            games[player.handle] = 0
-        games[player.handle] += 1
-    for player in games.keys():
-        d1, d2, f1, f2 = (
-            models.GameWeapon.query
-            .with_entities(db.func.sum(models.GameWeapon.damage1),
-                           db.func.sum(models.GameWeapon.damage2),
-                           db.func.sum(models.GameWeapon.frags1),
-                           db.func.sum(models.GameWeapon.frags2))
-            .filter(models.GameWeapon.playerhandle == player)
-            .filter(models.GameWeapon.game_id >= first_game)
-            .filter(db.func.re_normal_weapons(models.GameWeapon.game_id))
-            .filter(~models.GameWeapon.weapon.in_(
-                redeclipse.versions.default.notwielded
-                ))).first()
-        res_compiled[player] = {
-            "handle": player,
-            "dpf": (((d1 or 0) + (d2 or 0)) / max((f1 or 0) + (f2 or 0), 1)),
-            }
-    # Only count players who have played >= half the average number of games.
-    # This avoids small numbers of games from skewing the values.
-    gamemin = min([sum(games.values()) / max(len(games), 1) / 2,
-                   games and max(games.values()) or 0])
-    return [res_compiled[p] for p in sorted([p for p in res_compiled
-                                             if games[p] >= gamemin],
-                                            key=lambda p:
-                                                res_compiled[p]['dpf'])]
+    return _players_by_dpm(player_damage(days), limit)
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def players_by_dpf(days, limit=None, reverse=False):
+    """
+    Return a sorted list of players with and by dpf, at most <limit>, the
+    highest first if <reverse>.
+    Players with fewer than player_damage(days)['gamemin'] games are left
+    out.
+    """
+    return _players_by_dpf(player_damage(days), limit, reverse)
 
 
-@cached(10 * 60)
-def player_weapons(days):
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def player_weapons(days, limit=None):
     """
-    Return a sorted list of weapons and their best players with the most FPM.
+    Return a sorted list of weapons and their best players with the most FPM,
+    at most <limit>.
     """
     first_game = first_game_in_days(days)
+    notwielded = redeclipse.versions.default.notwielded
+    # Only the needed columns, streamed without building ORM objects.
     res = (models.GameWeapon.query
+           .with_entities(models.GameWeapon.weapon,
+                          models.GameWeapon.playerhandle,
+                          models.GameWeapon.damage1,
+                          models.GameWeapon.damage2,
+                          models.GameWeapon.timewielded,
+                          models.GameWeapon.timeloadout)
            .filter(models.GameWeapon.game_id >= first_game)
            .filter(models.GameWeapon.playerhandle != "")
-           .filter(db.func.re_normal_weapons(models.GameWeapon.game_id))
+           .filter(gameflags.re_normal_weapons(models.GameWeapon.game_id))
            .filter(models.GameWeapon.weapon.in_(
-               redeclipse.versions.default.standardweaponlist))).all()
+               redeclipse.versions.default.standardweaponlist))
+           .yield_per(10000))
     weapons = {}
     totaltime = 0
     lentime = 0
     for weapon in redeclipse.versions.default.standardweaponlist:
         weapons[weapon] = {}
-    for r in res:
-        res_compiled = weapons[r.weapon]
-        if r.playerhandle not in res_compiled:
-            res_compiled[r.playerhandle] = {
-                "handle": r.playerhandle,
+    for weapon, handle, damage1, damage2, timewielded, timeloadout in res:
+        res_compiled = weapons[weapon]
+        if handle not in res_compiled:
+            res_compiled[handle] = {
+                "handle": handle,
                 "damage": 0,
                 "time": 0,
                 }
-        res_compiled[r.playerhandle]['damage'] += (r.damage1 + r.damage2)
-        res_compiled[r.playerhandle]['time'] += r.time()
-        totaltime += res_compiled[r.playerhandle]['time']
+        res_compiled[handle]['damage'] += (damage1 + damage2)
+        # Same as GameWeapon.time().
+        res_compiled[handle]['time'] += (
+            timeloadout if weapon in notwielded else timewielded)
+        totaltime += res_compiled[handle]['time']
         lentime += 1
     for weapon in weapons:
         for h in weapons[weapon]:
             weapons[weapon][h]['dpm'] = (weapons[weapon][h]['damage'] /
                                          (max(weapons[weapon][h]['time'], 1) /
                                           60))
-        weapons[weapon] = [weapons[weapon][p] for p in sorted(
-                weapons[weapon], key=lambda p: weapons[weapon][p]['dpm'],
-                reverse=True)]
     # Only select weapons that have been used for some time, no quick switches.
     mintime = max(totaltime, 1) / max(lentime, 1) / 2
-    weapons_compiled = []
-    for weapon in weapons:
-        for player in weapons[weapon]:
-            if player['time'] >= mintime:
-                weapons_compiled.append({
-                    "weapon": weapon,
-                    "handle": player['handle'],
-                    "dpm": player['dpm'],
-                    })
+    # The best player of each weapon, the first one on ties.
     ret = []
-    seen = []
-    for entry in sorted(weapons_compiled,
-                        key=lambda w: w['dpm'],
-                        reverse=True):
-        if entry['weapon'] in seen:
-            continue
-        seen.append(entry['weapon'])
-        ret.append(entry)
+    for weapon in weapons:
+        players = [p for p in weapons[weapon].values()
+                   if p['time'] >= mintime]
+        if players:
+            player = max(players, key=lambda p: p['dpm'])
+            ret.append({
+                "weapon": weapon,
+                "handle": player['handle'],
+                "dpm": player['dpm'],
+                })
+    return _top(ret, lambda w: w['dpm'], limit, True)
+
+
+def today():
+    """
+    Return the current day in rollups.DailyPlayer.day and similar.
+    """
+    return int(time.time()) // (60 * 60 * 24)
+
+
+def _daily_weapons(first_day, last_day):
+    return _weapon_sums(rollups.sums(
+        rollups.DailyWeapon, ['weapon'], first_day, last_day,
+        rollups.DailyWeapon.weapon.in_(
+            redeclipse.versions.default.standardweaponlist),
+        **{c: c for c in extmodels.Weapon.columns}))
+
+
+def _daily_player_damage(first_day, last_day):
+    sums = rollups.sums(rollups.DailyPlayer, ['handle'], first_day, last_day,
+                        games='weapon_games')
+    sums.update(rollups.sums(
+        rollups.DailyWeapon, ['handle'], first_day, last_day,
+        ~rollups.DailyWeapon.weapon.in_(
+            redeclipse.versions.default.notwielded),
+        damage1='damage1', damage2='damage2', timewielded='timewielded',
+        frags1='frags1', frags2='frags2'))
+    return _player_damage(sums)
+
+
+# Rankings served from the daily rollups by leaderboard(), each a function
+# of (first_day, last_day, limit).
+LEADERBOARDS = {
+    'players-games': lambda first_day, last_day, limit: _by_games(
+        rollups.sums(rollups.DailyPlayer, ['handle'], first_day, last_day,
+                     games='games')["games"], limit),
+    'players-kdr': lambda first_day, last_day, limit: _players_by_kdr(
+        rollups.sums(rollups.DailyPlayer, ['handle'], first_day, last_day,
+                     games='ranked_games', frags='frags', deaths='deaths'),
+        limit),
+    'players-dpm': lambda first_day, last_day, limit: _players_by_dpm(
+        _daily_player_damage(first_day, last_day), limit),
+    'players-dpf': lambda first_day, last_day, limit: _players_by_dpf(
+        _daily_player_damage(first_day, last_day), limit),
+    'servers-games': lambda first_day, last_day, limit: _by_games(
+        rollups.sums(rollups.DailyServer, ['handle'], first_day, last_day,
+                     games='games')["games"], limit),
+    'maps-playertime': lambda first_day, last_day, limit: _maps_by_playertime(
+        rollups.sums(rollups.DailyMap, ['map'], first_day, last_day,
+                     games='games', time='time'), limit),
+    'weapons-wielded': lambda first_day, last_day, limit: _weapons_by_wielded(
+        _daily_weapons(first_day, last_day), limit),
+    'weapons-dpm': lambda first_day, last_day, limit: _weapons_by_dpm(
+        _daily_weapons(first_day, last_day), limit),
+}
+
+
+@cached(MAX_AGE, stale_ttl=STALE_TTL)
+def _leaderboard(name, first_day, last_day, limit, watermark):
+    return LEADERBOARDS[name](first_day, last_day, limit)
+
+
+def leaderboard(name, first_day, last_day, limit=None):
+    """
+    Return the LEADERBOARDS ranking <name> over whole UTC days from
+    first_day to last_day, at most <limit>.
+    """
+    # The rollups catch up with new games in the background, results are
+    # cached by how far they reach.
+    return _leaderboard(name, first_day, last_day, limit, rollups.watermark)
+
+
+def _run(app, f, args):
+    # Pool job, the app context gives it its own session, removed when the
+    # context ends.
+    with app.app_context():
+        return f(*args)
+
+
+def compute_all(calls, timeout=None):
+    """
+    Return a dict of the results of the cached (function, args) <calls> by
+    name, computed concurrently on a pool of RANKING_WORKERS threads.
+    Calls not finished within <timeout> seconds give their last cached
+    results, or None, and finish in the background for later requests.
+    """
+    global pool
+    app = current_app._get_current_object()
+    with pool_lock:
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(
+                app.config['RANKING_WORKERS'])
+    futures = {name: pool.submit(_run, app, f, args)
+               for name, (f, args) in calls.items()}
+    concurrent.futures.wait(futures.values(), timeout)
+    ret = {}
+    for name, future in futures.items():
+        f, args = calls[name]
+        ret[name] = (future.result() if future.done()
+                     else f.peek(*args))
     return ret
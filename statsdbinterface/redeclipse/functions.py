@@ -1,105 +1,222 @@
-from ..database.core import db_function, db
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+from ..database.core import db
 from . import versions
+from .idset import GameIdSet
 
 
-@db_function('re_normal_weapons')
-def re_normal_weapons(game_id):
-    if game_id in re_normal_weapons.cache:
-        return re_normal_weapons.cache[game_id]
-    re = versions.get_game_version(game_id)
-    ret = True
-    for mode in re.nonstandard_weapons['modes']:
-        if re_mode(game_id, mode):
-            ret = False
-            break
-    for mutator in re.nonstandard_weapons['mutators']:
-        if re_mut(game_id, mutator):
-            ret = False
-            break
-    re_normal_weapons.cache[game_id] = ret
-re_normal_weapons.cache = {}
-
-
-@db_function('re_mode')
-def re_mode(game_id, mode):
-    from ..database.models import Game
-    if mode in re_mode.precache and game_id <= re_mode.lastprecache:
-        return game_id in re_mode.precache[mode]
-
-    vclass = versions.get_game_version(game_id)
-
-    if game_id in re_mode.cache:
-        return re_mode.cache[game_id] == vclass.modes[mode]
-
-    game = Game.query.filter(Game.id == game_id).first()
-    re_mode.cache[game_id] = game.mode
-
-    return game.mode == vclass.modes[mode]
-
-
-re_mode.cache = {}
-re_mode.precache = {}
-re_mode.lastprecache = 0
-
-
-@db_function('re_mut')
-def re_mut(game_id, mut):
-    from ..database.models import Game
-    if mut in re_mut.precache and game_id <= re_mut.lastprecache:
-        return game_id in re_mut.precache[mut]
-
-    vclass = versions.get_game_version(game_id)
-
-    if game_id in re_mut.cache:
-        return mut in vclass.mutslist(
-            re_mut.cache[game_id][0],
-            re_mut.cache[game_id][1]
-        )
-
-    game = Game.query.filter(Game.id == game_id).first()
-
-    re_mut.cache[game_id] = (game.mode, game.mutators)
-
-    return mut in vclass.mutslist(game.mode, game.mutators)
+# Game id sets by mode and by mutator name, for the games up to last.
+precache = {
+    "modes": {},
+    "mutators": {},
+    "last": 0,
+}
 
+precache_lock = Lock()
+# Set once build_precache() has finished, see precached_games().
+precache_complete = False
 
-re_mut.cache = {}
-re_mut.precache = {}
-re_mode.lastprecache = 0
+# Rows fetched at once while precaching.
+PRECACHE_BATCH_SIZE = 10000
+# Log progress while precaching every this many games.
+PRECACHE_REPORT_INTERVAL = 100000
 
+# Snapshot files start with magic, format, last game id and the length of a
+# JSON index of the sections following it.
+SNAPSHOT_HEADER = struct.Struct('<8sIQQ')
+SNAPSHOT_MAGIC = b'REPCACHE'
+SNAPSHOT_FORMAT = 2
+# The mapped snapshot, the loaded precache uses views of it.
+snapshot_map = None
 
-@db_function('re_ver')
-def re_ver(version, vclass):
-    return type(versions.get_version_class(version)).__name__ == vclass
 
-
-def build_precache():
+def update_precache(report=False):
     """
-    Build a precache of games before the current run.
+    Extend the precache with games newer than the last precached game, in a
+    single pass filling every precache structure.
+    Return the number of games added.
     """
     from ..database.models import Game, GameServer
-    re_mut.lastprecache = re_mode.lastprecache = Game.query.with_entities(
-        db.func.max(Game.id)).first()[0]
-    for vclass in versions.registry:
-        for mode in vclass.modes:
-            if mode not in re_mode.precache:
-                re_mode.precache[mode] = set()
-            re_mode.precache[mode].update(
-                r[0] for r in
-                Game.query.with_entities(Game.id)
-                .join(Game.server)
-                .filter(db.func.re_ver(GameServer.version,
-                                       type(vclass).__name__))
-                .filter(Game.mode == vclass.modes[mode]).all()
-            )
-        for mut in vclass.mutators:
-            if mut not in re_mut.precache:
-                re_mut.precache[mut] = set()
-            re_mut.precache[mut].update(
-                r[0] for r in
-                Game.query.with_entities(Game.id)
-                .join(Game.server)
-                .filter(db.func.re_ver(GameServer.version,
-                                       type(vclass).__name__))
-                .filter(Game.mutators.op('&')(vclass.mutators[mut])).all()
-                )
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    added = 0
+    # Decoded (mode name, mutators) for each (class, mode, mutators).
+    decoded = {}
+    with precache_lock:
+        last = precache["last"]
+        for game_id, mode, mutators, version in (
+                Game.query.with_entities(Game.id, Game.mode, Game.mutators,
+                                         GameServer.version)
+                .outerjoin(Game.server)
+                .filter(Game.id > last)
+                .order_by(Game.id)
+                .yield_per(PRECACHE_BATCH_SIZE)):
+            # Games without a server are decoded like gameflags does.
+            vclass = versions.get_version_class(
+                version or versions.DEFAULT_VERSION)
+            versions.set_game_version(game_id, vclass)
+            key = (vclass.index, mode, mutators)
+            if key not in decoded:
+                decoded[key] = (vclass.cmodestr.get(mode),
+                                vclass.mutslist(mode, mutators))
+            modename, muts = decoded[key]
+            if modename is not None:
+                precache["modes"].setdefault(
+                    modename, GameIdSet()).add(game_id)
+            for mut in muts:
+                precache["mutators"].setdefault(
+                    mut, GameIdSet()).add(game_id)
+            last = game_id
+            added += 1
+            if report and not added % PRECACHE_REPORT_INTERVAL:
+                logger.info("Precached %d games, %d games/s.", added,
+                            added / max(time.time() - start, 0.001))
+        precache["last"] = last
+    if report:
+        elapsed = time.time() - start
+        logger.info("Precached %d games in %.2fs, %d games/s.", added,
+                    elapsed, added / max(elapsed, 0.001))
+    return added
+
+
+def precached_games(mode=None, mutator=None):
+    """
+    Return a GameIdSet of the games with <mode> and/or <mutator>, updating
+    the precache first.
+    While the precache is being built, the games are queried instead.
+    """
+    if not precache_complete:
+        from ..database import gameflags
+        from ..database.models import Game
+        query = Game.query.with_entities(Game.id)
+        if mode is not None:
+            query = query.filter(gameflags.re_mode(Game.id, mode))
+        if mutator is not None:
+            query = query.filter(gameflags.re_mut(Game.id, mutator))
+        return GameIdSet(row[0] for row in query)
+    update_precache()
+    sets = []
+    if mode is not None:
+        sets.append(precache["modes"].get(mode, GameIdSet()))
+    if mutator is not None:
+        sets.append(precache["mutators"].get(mutator, GameIdSet()))
+    return sets[0].intersection(*sets[1:])
+
+
+def save_precache(path):
+    """
+    Write the precache and versions.game_cache to a snapshot at <path>.
+    """
+    from ..database import gameflags
+    with precache_lock:
+        last = precache["last"]
+        size = (last >> 3) + 1
+        sections = [("game_cache", "", bytes(versions.game_cache[:last + 1]))]
+        for kind in ("modes", "mutators"):
+            for name, ids in sorted(precache[kind].items()):
+                sections.append((kind, name, bytes(ids.bits[:size])))
+    index = []
+    offset = 0
+    for kind, name, data in sections:
+        index.append((kind, name, offset, len(data)))
+        offset += len(data)
+    toc = json.dumps({
+        "signature": versions.signature(),
+        "fingerprint": gameflags.fingerprint(db.engine, last),
+        "sections": index,
+    }).encode()
+    # Replace the file at once, processes may be mapping the old one.
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, last,
+                                     len(toc)))
+        f.write(toc)
+        for kind, name, data in sections:
+            f.write(data)
+    os.replace(tmp, path)
+
+
+def load_precache(path, latest):
+    """
+    Replace the precache and versions.game_cache with views of the snapshot
+    at <path>, without copying it.
+    Return False if it is missing, was built by different version classes
+    or from a different stats database, or includes games after <latest>.
+    """
+    from ..database import gameflags
+    global snapshot_map
+    logger = logging.getLogger(__name__)
+    try:
+        with open(path, 'rb') as f:
+            # Pages are shared until written to, and stay private then.
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, last, toclen = SNAPSHOT_HEADER.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT:
+            raise ValueError("unknown format")
+        base = SNAPSHOT_HEADER.size + toclen
+        toc = json.loads(mapped[SNAPSHOT_HEADER.size:base].decode())
+        sections = toc["sections"]
+        if any(base + offset + length > len(mapped)
+               for kind, name, offset, length in sections):
+            raise ValueError("truncated")
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+        logger.warning("Ignoring precache snapshot %s: %s", path, e)
+        return False
+    if (toc.get("signature") != versions.signature() or
+            last > (latest or 0) or
+            toc.get("fingerprint") != gameflags.fingerprint(db.engine, last)):
+        return False
+    view = memoryview(mapped)
+    with precache_lock:
+        precache["modes"].clear()
+        precache["mutators"].clear()
+        for kind, name, offset, length in sections:
+            buf = view[base + offset:base + offset + length]
+            if kind == "game_cache":
+                versions.game_cache = buf
+            elif kind in ("modes", "mutators"):
+                precache[kind][name] = GameIdSet.from_buffer(buf)
+        precache["last"] = last
+        snapshot_map = mapped
+    logger.info("Loaded precache snapshot up to game %d.", last)
+    return True
+
+
+def build_precache(path=None):
+    """
+    Build a precache of games before the current run.
+    With <path>, start from the snapshot there and save it again when
+    games were added.
+    """
+    from ..database.models import Game
+    global precache_complete
+    precache_complete = False
+    latest = Game.query.with_entities(db.func.max(Game.id)).scalar()
+    if path is None or not load_precache(path, latest):
+        with precache_lock:
+            precache["modes"].clear()
+            precache["mutators"].clear()
+            precache["last"] = 0
+    if update_precache(report=True) and path is not None:
+        save_precache(path)
+    precache_complete = True
+
+
+def cache_stats():
+    """
+    Return size information for the precache.
+    """
+    from ..function_cache import sizeof
+    return {
+        "last": precache["last"],
+        "modes": sum(len(ids) for ids in precache["modes"].values()),
+        "mutators": sum(len(ids) for ids in precache["mutators"].values()),
+        "bytes": sizeof(precache, 3),
+    }
@@ -0,0 +1,68 @@
+class GameIdSet:
+    """
+    A set of non-negative game ids stored as a bitmap, one bit per id.
+    Set operations work on whole bitmaps at once.
+    """
+
+    def __init__(self, ids=()):
+        self.bits = bytearray()
+        self.update(ids)
+
+    @classmethod
+    def from_int(cls, value):
+        ret = cls()
+        ret.bits = bytearray(value.to_bytes((value.bit_length() + 7) // 8,
+                                            'little'))
+        return ret
+
+    @classmethod
+    def from_buffer(cls, buf):
+        """
+        Use the bytes-like buf as the bitmap without copying it.
+        """
+        ret = cls()
+        ret.bits = buf
+        return ret
+
+    def to_int(self):
+        return int.from_bytes(self.bits, 'little')
+
+    def add(self, game_id):
+        index = game_id >> 3
+        if index >= len(self.bits):
+            # A view from from_buffer() is copied before growing.
+            if not isinstance(self.bits, bytearray):
+                self.bits = bytearray(self.bits)
+            # Grow by at least half to keep appends cheap.
+            self.bits.extend(bytes(max(index + 1 - len(self.bits),
+                                       len(self.bits) // 2)))
+        self.bits[index] |= 1 << (game_id & 7)
+
+    def update(self, ids):
+        for game_id in ids:
+            self.add(game_id)
+
+    def __contains__(self, game_id):
+        index = game_id >> 3
+        return (0 <= index < len(self.bits) and
+                bool(self.bits[index] >> (game_id & 7) & 1))
+
+    def __len__(self):
+        return bin(self.to_int()).count('1')
+
+    def __iter__(self):
+        # Ascending order.
+        for index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield (index << 3) | bit
+
+    def intersection(self, *others):
+        value = self.to_int()
+        for other in others:
+            value &= other.to_int()
+        return GameIdSet.from_int(value)
+
+    def __repr__(self):
+        return '<GameIdSet of %d>' % len(self)
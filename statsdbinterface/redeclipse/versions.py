@@ -1,12 +1,18 @@
-from ..database.core import db
+import hashlib
 from collections import OrderedDict
 
 
 DEFAULT_VERSION = "1.5.8"
 
 registry = []
-game_cache = {}
+# Indexed by game id, 1 + the index of the game's class in registry, or 0 if
+# the game is not cached.
+# A memoryview of the snapshot file after functions.load_precache().
+game_cache = bytearray()
 version_cache = {}
+# Lookups of game_cache, misses query the database.
+game_cache_hits = 0
+game_cache_misses = 0
 
 
 def version_str_to_tuple(s):
@@ -33,26 +39,65 @@ def get_version_class(version):
         DEFAULT_VERSION))
 
 
+def set_game_version(game_id, vclass):
+    global game_cache
+    if game_id >= len(game_cache):
+        # A loaded snapshot is a read-only view, copy it before growing.
+        if not isinstance(game_cache, bytearray):
+            game_cache = bytearray(game_cache)
+        # Grow by at least half to keep appends cheap.
+        game_cache.extend(bytes(max(game_id + 1 - len(game_cache),
+                                    len(game_cache) // 2)))
+    game_cache[game_id] = vclass.index + 1
+
+
 def get_game_version(game_id):
-    from ..database.models import Game
-    if game_id not in game_cache:
-        game_cache[game_id] = Game.query.filter(
-            Game.id == game_id).first().server[0].version
-    return get_version_class(game_cache[game_id])
+    global game_cache_hits, game_cache_misses
+    from ..database.models import GameServer
+    if game_id < len(game_cache) and game_cache[game_id]:
+        game_cache_hits += 1
+        return registry[game_cache[game_id] - 1]
+    game_cache_misses += 1
+    version = (GameServer.query.with_entities(GameServer.version)
+               .filter(GameServer.game_id == game_id).scalar())
+    vclass = get_version_class(version or DEFAULT_VERSION)
+    set_game_version(game_id, vclass)
+    return vclass
+
+
+def cache_stats():
+    """
+    Return hit, miss and size information for game_cache.
+    """
+    from ..function_cache import sizeof
+    return {
+        "hits": game_cache_hits,
+        "misses": game_cache_misses,
+        "entries": len(game_cache) - bytes(game_cache).count(0),
+        "bytes": sizeof(game_cache),
+        "versions": len(version_cache),
+    }
 
 
-def build_precache():
-    from ..database.models import Game, GameServer
+def signature():
+    """
+    Return a string identifying the version classes, data derived with a
+    different set is rebuilt.
+    """
+    h = hashlib.sha1()
     for vclass in registry:
-        for r in (Game.query.with_entities(Game.id)
-                  .join(Game.server)
-                  .filter(db.func.re_ver(GameServer.version,
-                                         type(vclass).__name__)).all()):
-                        game_cache[r[0]] = vclass.startstr
+        h.update(repr((type(vclass).__name__, vclass.start, vclass.end,
+                       sorted(vclass.modes.items()),
+                       sorted(vclass.mutators.items()),
+                       sorted(vclass.gspmuts.items()),
+                       vclass.nonstandard_weapons)).encode())
+    return h.hexdigest()
 
 
 def reversion(c):
-    registry.append(c())
+    vclass = c()
+    vclass.index = len(registry)
+    registry.append(vclass)
     return c
 
 
@@ -0,0 +1,123 @@
+"""
+Background recomputation of registered rankings.
+
+Registered cached calls are refreshed every SCHEDULER_INTERVAL seconds and
+whenever the data version changes, so page views read precomputed results
+instead of computing them on a cache miss.
+"""
+import atexit
+import logging
+import time
+from threading import Thread, Lock
+from . import function_cache
+from .database import core
+
+# Cached (function, args) calls by job name.
+jobs = {}
+scheduler_thread = None
+scheduler_running = False
+stats_lock = Lock()
+# Counters and timings of each job, by job name.
+job_stats = {}
+# Start time, duration and data version of the last run of all jobs.
+last_run = None
+last_duration = None
+last_version = None
+
+# Seconds between runs, changed by setup(). None disables the scheduler.
+interval = 10 * 60
+
+
+def register(group, calls):
+    """
+    Register the cached (function, args) <calls>, a dict by name, as jobs
+    named <group>.<name>.
+    """
+    for name, call in calls.items():
+        jobs['%s.%s' % (group, name)] = call
+
+
+def run_jobs():
+    """
+    Refresh every registered job once.
+    """
+    global last_run, last_duration
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    for name, (f, args) in list(jobs.items()):
+        job_start = time.time()
+        failed = False
+        try:
+            f.refresh(*args)
+        except Exception:
+            logger.exception("Scheduled job %s failed.", name)
+            failed = True
+        with stats_lock:
+            if name not in job_stats:
+                job_stats[name] = {
+                    "runs": 0,
+                    "errors": 0,
+                    "last_run": None,
+                    "last_duration": None,
+                }
+            jstats = job_stats[name]
+            jstats["runs"] += 1
+            jstats["errors"] += failed
+            jstats["last_run"] = job_start
+            jstats["last_duration"] = time.time() - job_start
+    with stats_lock:
+        last_run = start
+        last_duration = time.time() - start
+
+
+def scheduler(app):
+    global last_version
+    # Before warm-up finishes the rankings use slower fallbacks.
+    while not core.warm.wait(0.1):
+        if not scheduler_running:
+            return
+    while scheduler_running:
+        with app.app_context():
+            version = function_cache.data_version()
+            if (last_run is None or version != last_version or
+                    time.time() - last_run >= interval):
+                last_version = version
+                run_jobs()
+        # Check every second, but periodically test for exit.
+        for i in range(0, 10):
+            time.sleep(0.1)
+            if not scheduler_running:
+                return
+
+
+def stats():
+    """
+    Return a dict describing the last runs.
+    """
+    with stats_lock:
+        return {
+            "interval": interval,
+            "last_run": last_run,
+            "last_duration": last_duration,
+            "jobs": {name: dict(jstats) for name, jstats
+                     in job_stats.items()},
+        }
+
+
+def cancel_scheduler():
+    global scheduler_running
+    scheduler_running = False
+
+
+def setup(app):
+    """
+    Apply the interval from the app config and start the scheduler thread.
+    """
+    global scheduler_running, scheduler_thread, interval
+    interval = app.config.get('SCHEDULER_INTERVAL', interval)
+    if interval is None or scheduler_running:
+        return
+    scheduler_thread = Thread(target=scheduler, args=(app,), daemon=True)
+    scheduler_running = True
+    scheduler_thread.start()
+    atexit.register(cancel_scheduler)
@@ -0,0 +1,97 @@
+"""
+Per-key sums over the games in a sliding window.
+
+A window covers the games from a first game id on. When it is read again,
+the games that arrived since are added and the games that left the window
+are subtracted, so refreshing only reads the games that changed.
+"""
+import collections
+from threading import Lock
+from .database import models
+from .database.core import db
+
+# Every SlidingSums, for stats().
+registry = []
+
+
+class SlidingSums:
+    """
+    Sums from collect(start, end), which returns a dict of Counters by field
+    for the games with start <= id < end. One window is kept for each
+    window name.
+    A range is never collected twice, so collect() must count every game in
+    it, including ones that arrive before the next data version sample.
+    """
+
+    def __init__(self, collect):
+        self.name = collect.__name__
+        self.collect = collect
+        self.lock = Lock()
+        # (first game, end, sums) by window name.
+        self.windows = {}
+        self.full = 0
+        self.incremental = 0
+        registry.append(self)
+
+    def sums(self, window, first_game):
+        """
+        Return the sums for the games from first_game on, updating the
+        previous sums of the same window if possible.
+        The returned Counters must not be changed.
+        """
+        end = (models.Game.query
+               .with_entities(db.func.max(models.Game.id))
+               .scalar() or 0) + 1
+        with self.lock:
+            previous = self.windows.get(window)
+            if (previous is not None and
+                    previous[0] <= first_game <= previous[1] <= end):
+                pfirst, pend, sums = previous
+                # Copy, the previous sums may still be in use.
+                sums = {field: collections.Counter(counter)
+                        for field, counter in sums.items()}
+                if end > pend:
+                    for field, counter in self.collect(pend, end).items():
+                        sums.setdefault(field, collections.Counter())
+                        sums[field].update(counter)
+                if first_game > pfirst:
+                    for field, counter in self.collect(
+                            pfirst, first_game).items():
+                        sums.setdefault(field, collections.Counter())
+                        sums[field].subtract(counter)
+                    prune(sums)
+                self.incremental += 1
+            else:
+                sums = self.collect(first_game, end)
+                self.full += 1
+            self.windows[window] = (first_game, end, sums)
+        return sums
+
+
+def sliding(f):
+    """
+    Decorator, return a SlidingSums collecting with f.
+    """
+    return SlidingSums(f)
+
+
+def prune(sums):
+    # Remove keys which are 0 in every field, left by games leaving.
+    keys = set()
+    for counter in sums.values():
+        keys.update(counter)
+    for key in keys:
+        if not any(counter.get(key) for counter in sums.values()):
+            for counter in sums.values():
+                counter.pop(key, None)
+
+
+def stats():
+    """
+    Return the number of full and incremental updates of each SlidingSums.
+    """
+    return {s.name: {
+        "full": s.full,
+        "incremental": s.incremental,
+        "windows": len(s.windows),
+        } for s in registry}
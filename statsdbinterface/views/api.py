@@ -1,7 +1,8 @@
 import math
 from flask import jsonify, request, Blueprint, current_app
-from werkzeug.exceptions import NotFound
-from ..database import models, extmodels
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable
+from ..database import models, extmodels, core, rollups
+from .. import function_cache, rankings, redeclipse, scheduler, sliding
 
 
 # api blueprint
@@ -23,6 +24,84 @@ def api_config():
     })
 
 
+@bp.route("/health")
+def api_health():
+    """
+    Return 200 while the server is running.
+    """
+
+    return jsonify({"status": "ok"})
+
+
+@bp.route("/ready")
+def api_ready():
+    """
+    Return 200 once warm-up has finished, 503 before.
+    """
+
+    ready = core.warm.is_set()
+    return jsonify({"ready": ready}), 200 if ready else 503
+
+
+@bp.route("/admin/cache")
+def api_admin_cache():
+    """
+    Return cache statistics.
+    """
+
+    return jsonify({
+        "function_cache": function_cache.stats(),
+        "redeclipse": redeclipse.functions.cache_stats(),
+        "versions": redeclipse.versions.cache_stats(),
+        "sliding": sliding.stats(),
+    })
+
+
+@bp.route("/admin/scheduler")
+def api_admin_scheduler():
+    """
+    Return the last run times and durations of the scheduled rankings.
+    """
+
+    return jsonify(scheduler.stats())
+
+
+@bp.route("/leaderboards/<string:name>")
+def api_leaderboard(name):
+    """
+    Return a page of <limit> entries of a leaderboard over the last <days>
+    whole days, today included.
+    <limit> is at most API_RESULTS_PER_PAGE.
+    """
+
+    if name not in rankings.LEADERBOARDS:
+        raise NotFound
+    days = request.args.get("days", default=7, type=int)
+    limit = request.args.get(
+        "limit", default=current_app.config['API_HIGHSCORE_RESULTS'],
+        type=int)
+    page = request.args.get("page", default=1, type=int)
+    if days < 1 or limit < 1 or page < 1:
+        raise BadRequest
+    limit = min(limit, current_app.config['API_RESULTS_PER_PAGE'])
+    if not rollups.complete:
+        raise ServiceUnavailable
+    last_day = rankings.today()
+    first_day = last_day - days + 1
+    if page == 1:
+        # The first page is a top-k selection, cached on its own.
+        results = rankings.leaderboard(name, first_day, last_day, limit)
+    else:
+        results = rankings.leaderboard(name, first_day, last_day)[
+            (page - 1) * limit:page * limit]
+    return jsonify({
+        "name": name,
+        "days": days,
+        "page": page,
+        "results": results,
+    })
+
+
 @bp.route("/count/games")
 def api_count_games():
     """
@@ -1,16 +1,36 @@
-import time
+import calendar
 
 from flask import current_app
 from flask import Blueprint, render_template, send_from_directory, request
 
-from ..database import models, extmodels
+from ..database import models, extmodels, gameflags
 from ..database.core import db
 from . import templateutils
-from .. import rankings
+from .. import rankings, scheduler
 
 # displays blueprint
 bp = Blueprint(__name__, __name__)
 
+# Dashboard rankings by template name, (function, args).
+DASHBOARD_RANKINGS = {
+    'players_by_games': (rankings.players_by_games, (7, 5)),
+    'servers_by_games': (rankings.servers_by_games, (7, 5)),
+    'players_by_dpm': (rankings.players_by_dpm, (7, 5)),
+    'players_by_least_dpf': (rankings.players_by_dpf, (7, 3)),
+    'players_by_most_dpf': (rankings.players_by_dpf, (7, 2, True)),
+    'maps_by_playertime': (rankings.maps_by_playertime, (30, 5)),
+    'weapons_by_wielded': (rankings.weapons_by_wielded, (30, 5)),
+    'weapons_by_dpm': (rankings.weapons_by_dpm, (30, 5)),
+    'players_by_kdr': (rankings.players_by_kdr, (30, 5)),
+}
+scheduler.register('dashboard', DASHBOARD_RANKINGS)
+scheduler.register('modes', {
+    'modes_by_games': (rankings.modes_by_games, (30,)),
+})
+scheduler.register('mutators', {
+    'mutators_by_games': (rankings.mutators_by_games, (30,)),
+})
+
 
 @bp.route('/static/<path:path>')
 def static(path):
@@ -23,7 +43,9 @@ def display_dashboard():
         current_app.config['DISPLAY_RESULTS_RECENT']).all()
     return render_template('displays/dashboard.html',
                            games=games,
-                           rankings=rankings)
+                           rankings=rankings.compute_all(
+                               DASHBOARD_RANKINGS,
+                               current_app.config['RANKING_TIMEOUT']))
 
 
 @bp.route("/games")
@@ -102,9 +124,9 @@ def display_player(handle):
     player = extmodels.Player.get_or_404(handle)
     games = (models.Game.query
              .with_entities(models.Game.id)
-             .filter(~db.func.re_mode(models.Game.id, 'race'))
-             .filter(~db.func.re_mut(models.Game.id, 'insta'))
-             .filter(~db.func.re_mut(models.Game.id, 'medieval'))
+             .filter(~gameflags.re_mode(models.Game.id, 'race'))
+             .filter(~gameflags.re_mut(models.Game.id, 'insta'))
+             .filter(~gameflags.re_mut(models.Game.id, 'medieval'))
              .filter(models.Game.id.in_(player.game_ids))
              .order_by(models.Game.id.desc()).limit(50))
     weapons = extmodels.Weapon.all_from_player_games(handle, games)
@@ -236,7 +258,7 @@ def display_mutator_games(name):
 def display_weapons():
     games = (models.Game.query
              .with_entities(models.Game.id)
-             .filter(db.func.re_normal_weapons(models.Game.id))
+             .filter(gameflags.re_normal_weapons(models.Game.id))
              .order_by(models.Game.id.desc()).limit(300))
     weapons = extmodels.Weapon.all_from_games(games)
 
@@ -255,22 +277,16 @@ def display_weapons():
 
 @bp.route("/activehours")
 def display_activehours():
-    minutes = int(templateutils.time_str(time.time(), "%M"))
-    days = (1 / 24 / 60) * (24 * 60 * 30 + minutes)
-    thishour = templateutils.time_str(time.time(), "%F %H")
-    first_game = rankings.first_game_in_days(days)
+    # The last 30 days, ending before the current hour.
+    counts = rankings.game_hours(30, 60 * 60)
     times = {}
-    for game in (models.Game.query
-                 .filter(models.Game.id >= first_game)):
-        hour = int(templateutils.time_str(game.time, "%H"))
-        if templateutils.time_str(game.time, "%F %H") == thishour:
-            continue
+    for (dayidx, hour), players in counts.items():
         if hour not in times:
             times[hour] = {
                 "players": 0
             }
-        times[hour]["players"] += 1
-    barfactor = 100 / max([times[t]["players"] for t in times])
+        times[hour]["players"] += players
+    barfactor = 100 / max([times[t]["players"] for t in times] or [1])
     for hour in times:
         times[hour]["hour"] = hour
         times[hour]["label"] = hour
@@ -286,26 +302,17 @@ def display_activehours():
 
 @bp.route("/activeweekdays")
 def display_activeweekdays():
-    gmtime = time.gmtime()
-    secondsleftinday = 24 * 60 * 60 - (
-        gmtime.tm_sec + gmtime.tm_min * 60 + gmtime.tm_hour * 3600)
-    days = 7 * 4 + (secondsleftinday / 24 / 60 / 60)
-    first_game = rankings.first_game_in_days(days)
-    today = templateutils.time_str(time.time(), "%F")
+    # The last 4 weeks, ending before today.
+    counts = rankings.game_hours(7 * 4, 24 * 60 * 60)
     times = {}
-    for game in (models.Game.query
-                 .filter(models.Game.id >= first_game)):
-        if templateutils.time_str(game.time, "%F") == today:
-            continue
-        dayidx = int(templateutils.time_str(game.time, "%u"))
-        day = templateutils.time_str(game.time, "%a")
+    for (dayidx, hour), players in counts.items():
         if dayidx not in times:
             times[dayidx] = {
                 "players": 0,
-                "label": day,
+                "label": calendar.day_abbr[dayidx - 1],
             }
-        times[dayidx]["players"] += 1
-    barfactor = 100 / max([times[t]["players"] for t in times])
+        times[dayidx]["players"] += players
+    barfactor = 100 / max([times[t]["players"] for t in times] or [1])
     for day in times:
         times[day]["day"] = day
         times[day]["players"] = round(times[day]["players"], 1)
@@ -319,30 +326,17 @@ def display_activeweekdays():
 
 @bp.route("/activeweekdayhours")
 def display_activeweekdayhours():
-    gmtime = time.gmtime()
-    secondsleftinday = 24 * 60 * 60 - (
-        gmtime.tm_sec + gmtime.tm_min * 60 + gmtime.tm_hour * 3600)
-    days = 7 * 4 + (secondsleftinday / 24 / 60 / 60)
-    first_game = rankings.first_game_in_days(days)
-    today = templateutils.time_str(time.time(), "%F")
+    # The last 4 weeks, ending before today.
+    counts = rankings.game_hours(7 * 4, 24 * 60 * 60)
     times = {}
-    for game in (models.Game.query
-                 .filter(models.Game.id >= first_game)):
-        if templateutils.time_str(game.time, "%F") == today:
-            continue
-        dayidx = int(templateutils.time_str(game.time, "%u"))
-        day = templateutils.time_str(game.time, "%a")
-        hour = int(templateutils.time_str(game.time, "%H"))
-        idx = (dayidx, hour)
-        if idx not in times:
-            times[idx] = {
-                "players": 0,
-                "label": "%s %d" % (day, hour),
-                "day": dayidx,
-                "hour": hour,
-            }
-        times[idx]["players"] += 1
-    barfactor = 100 / max([times[t]["players"] for t in times])
+    for (dayidx, hour), players in counts.items():
+        times[(dayidx, hour)] = {
+            "players": players,
+            "label": "%s %d" % (calendar.day_abbr[dayidx - 1], hour),
+            "day": dayidx,
+            "hour": hour,
+        }
+    barfactor = 100 / max([times[t]["players"] for t in times] or [1])
     for idx in times:
         times[idx]["players"] = round(times[idx]["players"], 1)
         times[idx]["bar"] = "|" * round(times[idx]["players"] * barfactor)
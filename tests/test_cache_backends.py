@@ -0,0 +1,86 @@
+import socket
+import socketserver
+import threading
+import time
+import unittest
+
+from statsdbinterface.cache_backends import MemcachedCache
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    # Just enough of the memcached text protocol for MemcachedCache.
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if parts[0] == b'get':
+                for key in parts[1:]:
+                    if key in store:
+                        self.wfile.write(b'VALUE %s 0 %d\r\n%s\r\n' % (
+                            key, len(store[key]), store[key]))
+                self.wfile.write(b'END\r\n')
+            elif parts[0] == b'set':
+                value = self.rfile.read(int(parts[4]) + 2)[:-2]
+                store[parts[1]] = value
+                self.wfile.write(b'STORED\r\n')
+
+
+class MemcachedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      MemcachedHandler)
+        self.server.daemon_threads = True
+        self.server.store = {}
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.cache = MemcachedCache(*self.server.server_address)
+
+    def tearDown(self):
+        self.cache._close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_set(self):
+        created = time.time()
+        self.assertIsNone(self.cache.get(('f', (7,), ()), 1))
+        self.cache.put(('f', (7,), ()), 1, created, 60, [{"games": 3}])
+        self.assertEqual(self.cache.get(('f', (7,), ()), 1),
+                         (created, [{"games": 3}]))
+        self.assertIsNone(self.cache.get(('f', (30,), ()), 1))
+        self.assertEqual(self.cache.errors, 0)
+
+    def test_version_mismatch(self):
+        self.cache.put('key', (10, 1.0), time.time(), 60, 'old')
+        self.assertIsNone(self.cache.get('key', (11, 1.0)))
+
+    def test_expired(self):
+        self.cache.put('key', 1, time.time() - 120, 60, 'old')
+        self.assertIsNone(self.cache.get('key', 1))
+
+    def test_connection_error(self):
+        # Nothing listens on a port that was just released.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        cache = MemcachedCache('127.0.0.1', port, timeout=0.5)
+        cache.put('key', 1, time.time(), 60, 'value')
+        self.assertIsNone(cache.get('key', 1))
+        self.assertEqual(cache.errors, 2)
+
+    def test_reconnect(self):
+        self.cache.put('key', 1, time.time(), 60, 'value')
+        # A dropped connection is reopened by the next command.
+        self.cache.sock.close()
+        self.assertIsNone(self.cache.get('key', 1))
+        self.assertEqual(self.cache.errors, 1)
+        self.assertEqual(self.cache.get('key', 1)[1], 'value')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from statsdbinterface import app_factory, defaults, function_cache, sliding
+from statsdbinterface.database import models  # noqa: F401 (tables)
+from statsdbinterface.database.core import db
+
+MAPS = 8
+PLAYERS = 12
+GAMES = 40
+
+
+def create_fixture(path):
+    # A stats database with GAMES recent games on MAPS maps, each with two
+    # of PLAYERS players using two weapons.
+    engine = db.create_engine('sqlite:///%s' % path, {})
+    for table in db.metadata.sorted_tables:
+        if table.schema is None:
+            table.create(engine)
+    engine.dispose()
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    for game in range(1, GAMES + 1):
+        conn.execute('INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (game, now - (GAMES - game) * 600,
+                      'map%d' % (game % MAPS), 2, 0, 300, 2, 1))
+        conn.execute('INSERT INTO game_servers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (game, 'server', '', '', '1.5.8', 'localhost', 28801))
+        for player in range(2):
+            handle = 'p%d' % ((game + player * 5) % PLAYERS)
+            conn.execute(
+                'INSERT INTO game_players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (game, handle, handle, 10, 250, 5 + player, 4, player, 280))
+            for weapon in ('pistol', 'rifle'):
+                conn.execute(
+                    'INSERT INTO game_weapons VALUES (%s)' % ', '.join(
+                        '?' * 18),
+                    (game, player, handle, weapon, 120, 150,
+                     900 + game, 3, 20, 0, 40, 0,
+                     100, 1, 5, 0, 10, 0))
+    conn.commit()
+    conn.close()
+
+
+class QueryCountTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        create_fixture('%s/stats.sqlite' % cls.data_dir)
+        interval = defaults.SCHEDULER_INTERVAL
+        # Keep the scheduler from computing rankings during the tests.
+        defaults.SCHEDULER_INTERVAL = None
+        try:
+            cls.app = app_factory.create_app(cls.data_dir)
+        finally:
+            defaults.SCHEDULER_INTERVAL = interval
+        from statsdbinterface import rankings
+        cls.rankings = rankings
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        # Start cold, but with a current data version.
+        with function_cache.cache_lock:
+            for key in list(function_cache.cache):
+                function_cache._remove(key)
+        for totals in sliding.registry:
+            totals.windows.clear()
+        function_cache.version_sampled = 0
+        function_cache.data_version()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def statements(self, f, *args):
+        # Return f(*args) and the statements it ran in this thread.
+        thread = threading.get_ident()
+        ran = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if threading.get_ident() == thread:
+                ran.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        try:
+            results = f(*args)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+        return results, ran
+
+    def test_maps_by_playertime(self):
+        maps, ran = self.statements(self.rankings.maps_by_playertime, 30)
+        self.assertEqual(len(maps), MAPS)
+        self.assertEqual(sum(m['games'] for m in maps), GAMES)
+        # One grouped query for the player time of every map, not one each.
+        self.assertEqual(len([s for s in ran if 'game_players' in s]), 1)
+        self.assertEqual(len(ran), 4)
+
+    def test_players_by_dpm_and_dpf(self):
+        players, ran = self.statements(self.rankings.players_by_dpm, 30)
+        self.assertEqual(len(players), PLAYERS)
+        # One grouped query for the weapons of every player, not one each.
+        self.assertEqual(len([s for s in ran if 'game_weapons' in s]), 1)
+        self.assertEqual(len(ran), 4)
+        players, ran = self.statements(self.rankings.players_by_dpf, 30)
+        self.assertEqual(len(players), PLAYERS)
+        # player_damage() is shared with players_by_dpm.
+        self.assertEqual(ran, [])
+
+
+if __name__ == '__main__':
+    unittest.main()